@@ -1,13 +1,32 @@
 import argparse
+import array
+import glob
+import hashlib
+import collections
+import contextlib
+import cProfile
+import concurrent.futures
+import ctypes
+import ctypes.util
+import json
+import lzma
 import struct
 import re
 import os
-import shlex
 import sys
-import functools
-import itertools
 import zipfile
+import io
+import mmap
+import pickle
+import pstats
+import select
 import shutil
+import sqlite3
+import threading
+import time
+import traceback
+import tracemalloc
+import zlib
 
 # vmt parameters that reference a vtf texture (all $...2 parameters work as well)
 vtf_keys = set(['$texture', '$basetexture', '$detail', '$blendmodulatetexture', '$bumpmap',
@@ -17,236 +36,1765 @@ vtf_keys = set(['$texture', '$basetexture', '$detail', '$blendmodulatetexture',
                 '$emissiveblendbasetexture', '$emissiveblendflowtexture', '$phongexponenttexture'])
 vmt_keys = set(['$bottommaterial', '$underwateroverlay'])
 
-# dictionary mdlfile->set(skins) so we don't pack unused skins
-model_skins = {}
-
-# set of models we'll use every single skin on
-all_model_skins = set()
-
-# main file list (filename->boolean have we checked it for subdependencies)
-dependencies = {}
-
-# exclusion list of compiled regexes (from nopack.txt)
-dontpack = []
-
-game_bspzip_target = '..\\bin\\bspzip.exe'
-hl2_bspzip_target = '"..\\..\\Half-Life 2\\bin\\bspzip.exe"'
-
-# Where to look for files
-mounts = []
-
-# relative path to absolute path
-file_location = {}
-
-# tuples of (filename, size)
-file_sizes = []
+# entity key->what its value refers to
+entity_key_kinds = {
+    'model': "model",
+    'skin': "skin",
+    'targetname': "targetname",
+    'texture': "material",
+    'material': "material",
+    'detailmaterial': "material",
+    'ropematerial': "material",
+    'skyname': "skybox",
+    'message': "sound",
+    'noise1': "sound",
+    'noise2': "sound",
+    'startsound': "sound",
+    'stopsound': "sound",
+    'movesound': "sound",
+    'movepingsound': "sound",
+    'startclosesound': "sound",
+    'closesound': "sound",
+    'locked_sound': "sound",
+    'unlocked_sound': "sound",
+    'soundopenoverride': "sound",
+    'soundcloseoverride': "sound",
+    'soundmoveoverride': "sound",
+    'soundlockedoverride': "sound",
+    'soundunlockedoverride': "sound",
+    'effect_name': "particle",
+    'soundscape': "soundscape",
+}
+
+# characters at the start of a sound name that tell the engine how to play it
+sound_chars = "*#@<>^)}$!?&~("
+
+# files a "particle:", "soundscript:" or "soundscape:" name is looked up in, in each mount: (wildcard, manifest
+# listing more of them). These are only for loose files; the game's own scripts are in its vpks and never packed.
+script_locations = {
+    "pcf": ("particles/**/*.pcf", "particles/particles_manifest.txt"),
+    "soundscripts": ("scripts/game_sounds*.txt", "scripts/game_sounds_manifest.txt"),
+    "soundscapes": ("scripts/soundscapes_*.txt", "scripts/soundscapes_manifest.txt"),
+}
+
+# start of a binary DMX file (like a pcf), before the string table
+dmx_header = re.compile(rb'<!-- dmx encoding binary (\d+) format (\S+) (\d+) -->\s*\0')
+
+# a "key" "value" line in the entity lump, or a brace
+entity_keyvalue = re.compile(b'"([^"\n]*)"[ \t]*"([^"\n]*)"|([{}])')
+
+# sound files mentioned in entity values
+sound_filename = re.compile("[a-z0-9_\\- /\\\\]+\\.(?:wav|ogg|mp3)")
+
+# comment on the pakfile entries QuickPack adds, so --incremental knows which ones it may remove
+pack_marker = b"quickpack"
+
+# --compress methods, and the text files they're used for. Everything else (vtf, mp3, wav, models) is
+# stored, so the engine can load it without unpacking.
+compression_methods = {"none": zipfile.ZIP_STORED, "deflate": zipfile.ZIP_DEFLATED, "lzma": zipfile.ZIP_LZMA}
+compressible_extensions = set(["vmt", "txt", "nav", "kv", "res", "cfg", "lst", "vdf"])
+
+# smaller files are stored, since compressing them saves nothing
+compress_min_size = 512
+
+# --plan: files bigger than this are only compressed this far, and their size is projected from the ratio
+plan_sample_size = 4 << 20
+# how many of the biggest textures and sources --plan lists. Textures of --warn-filesize or more are always listed.
+plan_top = 10
+
+# --plan categories by file extension (anything else is "other")
+plan_categories = {
+    "vtf": "textures",
+    "vmt": "materials",
+    "mdl": "models",
+    "vtx": "models",
+    "vvd": "models",
+    "phy": "models",
+    "ani": "models",
+    "wav": "sounds",
+    "mp3": "sounds",
+    "ogg": "sounds",
+    "pcf": "particles",
+    "txt": "scripts",
+    "nav": "navigation",
+}
+
+# vtf image formats, by their number in the header
+vtf_formats = ["RGBA8888", "ABGR8888", "RGB888", "BGR888", "RGB565", "I8", "IA88", "P8", "A8", "RGB888_BLUESCREEN",
+               "BGR888_BLUESCREEN", "ARGB8888", "BGRA8888", "DXT1", "DXT3", "DXT5", "BGRX8888", "BGR565", "BGRX5551",
+               "BGRA4444", "DXT1_ONEBITALPHA", "BGRA5551", "UV88", "UVWQ8888", "RGBA16161616F", "RGBA16161616",
+               "UVLX8888"]
+
+# id of the static prop game lump ('sprp')
+staticprop_lump_id = 1936749168
+
+# static prop lump version->known sizes of one static prop, most common first
+# (gmod and other branches sometimes change the layout without changing the version)
+staticprop_record_sizes = {
+    4: (56,),
+    5: (60,),
+    6: (64,),
+    7: (68, 72),
+    8: (68,),
+    9: (72,),
+    10: (76, 72),
+    11: (80, 76),
+}
+
+# folders of the mounts that are indexed up front, instead of looking for each file in every mount
+indexed_folders = ["materials", "models", "sound"]
+
+# folder in the game root for files we cache between runs
+cache_folder = "quickpack_cache"
+
+# --watch: seconds between checks of the maps folder (or between inotify timeouts), and how long a
+# changed map has to stay the same before it's packed, so it isn't packed while the compiler is writing it
+watch_poll_interval = 1.0
+watch_idle_timeout = 30.0
+watch_settle_time = 2.0
+
+# inotify events (from sys/inotify.h) that mean a file in the watched folder may have changed
+inotify_events = 0x2 | 0x8 | 0x80 | 0x100 | 0x200  # IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_DELETE
+
+# settings for packing a map (the same as the command line options), and their defaults
+default_options = {
+    "minify_vmt": False,
+    "warn_filesize": 1000,
+    "jobs": 1,
+    "compress": "none",
+    "incremental": False,
+    "profile": False,
+    "profile_python": False,
+    "profile_memory": False,
+    "graph": None,
+    "manifest": None,
+    "plan": False,
+    "max_size": None,
+}
+
+# Make the settings for Packer.pack, like pack_options(minify_vmt=True, jobs=4)
+
+
+def pack_options(**options):
+    for name in options:
+        if name not in default_options:
+            raise TypeError("unknown pack option "+name)
+    return argparse.Namespace(**dict(default_options, **options))
+
+# Packing a map failed. The message says why.
+
+
+class PackError(Exception):
+    pass
 
 
 def main():
     print("\nQuickPack v1.63 by Jackson Cannon - https://github.com/cannon/quickpack")
 
     parser = argparse.ArgumentParser(description='Process some integers.')
-    parser.add_argument('mapfile', help='Path to map file')
+    parser.add_argument('mapfile', nargs='?', help='Path to map file')
+    parser.add_argument('--batch', nargs='+', metavar='MAP',
+                        help='Pack many maps (paths or wildcards like maps/*.bsp) at once instead of mapfile')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, metavar='N',
+                        help='With --batch, pack up to N maps at once')
+    parser.add_argument('--batch-summary', metavar='FILE',
+                        help='With --batch, write the time and packed size of each map to a JSON file')
     parser.add_argument('--hl2', action="store_true",
-                        help='Use Half-Life 2 bspzip.exe')
+                        help="Does nothing. QuickPack no longer runs bspzip.exe, so it doesn't need Half-Life 2's")
     parser.add_argument('--minify-vmt', action="store_true",
                         help='Remove comments/whitespace/%keywords from VMTs')
-    parser.add_argument('--warn-filesize', type=int, default=1000,
+    parser.add_argument('--warn-filesize', type=int, default=default_options["warn_filesize"],
                         help='Files at least this many KB will be printed')
+    parser.add_argument('--jobs', '-j', type=int, default=default_options["jobs"], metavar='N',
+                        help='Check up to N files at once (helps with content on network drives)')
+    parser.add_argument('--check-vpks', action="store_true",
+                        help="Also look for custom files used by models and materials in the game's vpks")
+    parser.add_argument('--no-cache', action="store_true",
+                        help="Don't read or write cached file lists and parsed files in "+cache_folder)
+    parser.add_argument('--compress', choices=sorted(compression_methods), default=default_options["compress"],
+                        help='Compress text files (vmt, txt, nav...) in the pakfile. Check that your game '
+                        'supports the method first (lzma works in CS:GO and TF2)')
+    parser.add_argument('--incremental', action="store_true",
+                        help='Only add, replace or remove files that changed since the map was last packed')
+    parser.add_argument('--profile', action="store_true",
+                        help='Write the time taken by each step and counts of the work done to '
+                        'mapname.quickpack_profile.json next to the map')
+    parser.add_argument('--profile-python', action="store_true",
+                        help='With --profile, also run cProfile (saved to mapname.quickpack_profile.prof)')
+    parser.add_argument('--profile-memory', action="store_true",
+                        help='With --profile, also trace memory use with tracemalloc')
+    parser.add_argument('--graph', metavar='FILE',
+                        help='Write the dependency graph (file->files it pulled in) to a JSON file')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='Write the source, size, hash and parents (like entity->mdl->vmt->vtf) of each packed '
+                        'file to a JSON file, or one file per line if FILE ends with .jsonl')
+    parser.add_argument('--plan', action="store_true",
+                        help="Dry run: print the projected pakfile and map size by category, the biggest textures "
+                        "and what pulls in the most bytes, without changing the map")
+    parser.add_argument('--max-size', type=int, metavar='KB',
+                        help='Fail before writing anything if the packed map would be bigger than this many KB')
+    parser.add_argument('--watch', metavar='FOLDER',
+                        help="Keep running, and pack each map in a game's maps FOLDER when it's recompiled")
     args = parser.parse_args()
 
     if sys.version_info[0] != 3:
         print("Please run this with Python 3")
         sys.exit()
 
+    if args.watch:
+        if args.mapfile or args.batch or args.graph or args.manifest:
+            parser.error("--watch can't be used with mapfile, --batch, --graph or --manifest")
+        watch_maps(args)
+        return
+    if args.batch:
+        if args.mapfile or args.graph or args.manifest:
+            parser.error("--batch can't be used with mapfile, --graph or --manifest")
+        pack_batch(args)
+        return
+    if not args.mapfile:
+        parser.error("a map file (or --batch) is required")
+
     abspath = os.path.abspath(args.mapfile)
+    error = map_path_error(abspath)
+    if error is not None:
+        print(error)
+        sys.exit(1)
+
+    profiler = Profiler()
+    try:
+        with profiler.phase("index"):
+            packer = Packer(os.path.dirname(os.path.dirname(abspath)),
+                            use_cache=not args.no_cache, check_vpks=args.check_vpks)
+        packer.pack(abspath, args, profiler)
+    except PackError as e:
+        print(str(e))
+        sys.exit(1)
+    packer.save_cache()
+
+# Check that a map is a bsp in a game's maps folder. Returns what's wrong, or None.
+
+
+def map_path_error(abspath):
     if not os.path.isfile(abspath):
-        print("File does not exist: "+abspath)
-        sys.exit()
-
-    pathparts = abspath.replace("/", "\\").split("\\")
-
-    os.chdir('\\'.join(pathparts[0:-2]))
-
-    bspzip_target = game_bspzip_target
+        return "File does not exist: "+abspath
+    if not abspath.lower().endswith(".bsp"):
+        return "Not a BSP file: "+abspath
+    if not os.path.basename(os.path.dirname(abspath)).lower() == "maps":
+        return "Not in a valid game directory: "+abspath
+    return None
 
-    if not os.path.isfile(bspzip_target):
-        print("\nbspzip.exe not found for this game. Trying HL2 instead.")
-        bspzip_target = hl2_bspzip_target
-    elif args.hl2:
-        bspzip_target = hl2_bspzip_target
-    elif pathparts[-3] == "garrysmod":
-        print("\nWarning: bspzip.exe for this game might not work. Try passing -hl2 if you get an error.")
+# The game folder and the folders in its cfg/mount.cfg, which can be relative to the game folder
 
-    if bspzip_target == hl2_bspzip_target and not os.path.isfile(bspzip_target[1:-1]):
-        print("\nPlease install Half-Life 2 on the same drive as this game to use its bspzip.exe.")
-        sys.exit()
-
-    if not pathparts[-1].lower().endswith(".bsp"):
-        print("Not a BSP file: "+abspath)
-        sys.exit()
 
-    if not pathparts[-2].lower() == "maps":
-        print("Not in a valid game directory: "+abspath)
-        sys.exit()
-
-    gameroot = os.getcwd()
-
-    mounts.append(gameroot)
+def read_mounts(gameroot):
+    mounts = [gameroot]
     mountfile = gameroot+"/cfg/mount.cfg"
     if os.path.isfile(mountfile):
-        file = open(mountfile, 'r')
-        content = file.read().lower().strip()
-        content = shlex_split_comments(content)
-        if content[0] == "mountcfg" and content[1] == "{" and content[-1] == "}":
-            mounts.extend(content[3::2])
+        file = open(mountfile, 'r', errors="replace")
+        content = file.read()
+        file.close()
+        tokens = kv_tokens(content)
+        if next(tokens, (None, ""))[1].lower() == "mountcfg" and next(tokens, (None, ""))[1] == "{":
+            for path, key, value in kv_pairs(kv_tokens(content)):
+                if len(path) == 1 and path[0].lower() == "mountcfg":
+                    mounts.append(os.path.join(gameroot, value))
             print("Looking in mounts: "+str(mounts))
         else:
             print("Warning: malformed mount.cfg")
-
-    mapfilepath = '/'.join(pathparts[-2:]).lower()
-    mapfilepath_cmd = cmd_path(gameroot+"/"+mapfilepath)
-    mapname = pathparts[-1].lower().replace(".bsp", "")
-
-    # Add global dependencies to look for
-    dependencies["maps/"+mapname+".txt"] = False
-    dependencies["maps/"+mapname+".nav"] = False
-    dependencies["maps/"+mapname+".kv"] = False
-    dependencies["maps/cfg/"+mapname+".cfg"] = False
-    dependencies["resource/overviews/"+mapname+".txt"] = False
-    dependencies["resource/overviews/"+mapname+"_radar.dds"] = False
-    dependencies["resource/overviews/"+mapname+"_radar_spectate.dds"] = False
-    dependencies["resource/overviews/"+mapname+"_lower_radar.dds"] = False
-    dependencies["resource/overviews/"+mapname+"_higher_radar.dds"] = False
-
-    textfile_name = mapfilepath.replace(".bsp", ".pack.txt")
-    if os.path.isfile(textfile_name):
-        print("\nAdding files from " +
-              (sanitize_filename(textfile_name).split("/")[-1])+"...")
-        textfile = open(textfile_name, 'r')
-        textfilecontent = textfile.readlines()
-        textfile.close()
-        for i in textfilecontent:
-            dependencies[sanitize_filename(i)] = False
-
-    textfile_name = mapfilepath.replace(".bsp", ".nopack.txt")
-    if os.path.isfile(textfile_name):
-        print("\nRemoving files from " +
-              (sanitize_filename(textfile_name).split("/")[-1])+"...")
-        textfile = open(textfile_name, 'r')
-        textfilecontent = textfile.readlines()
-        textfile.close()
-        for i in textfilecontent:
-            dontpack.append(re.compile("^"+i.strip()+"$"))
-
-    print("\nReading "+mapname+".bsp...")
-
-    delete_file("maps/quickpacktemp.zip")
-    delete_dir("maps/quickpacktemp")
-
-    os.system(bspzip_target + " -extract "+mapfilepath_cmd+" " +
-              cmd_path(gameroot+"/maps/quickpacktemp.zip")+" > nul 2>&1")
-
-    # Unpack patch materials made by the compiler
-    unpack_files = set()
-    zf = zipfile.ZipFile("maps/quickpacktemp.zip")
-    for f in zf.infolist():
-        f = sanitize_filename(f.filename)
-        if f.startswith("materials/maps/"):
-            unpack_files.add(f)
-    zf.extractall("maps/quickpacktemp", unpack_files)
-    zf.close()
-    delete_file("maps/quickpacktemp.zip")
-
-    for f in unpack_files:
-        dependencies[sanitize_filename("maps/quickpacktemp/"+f)] = False
-
-    bsp_file = open(abspath, 'rb')
-
-    read_texture_lump(bsp_file)
-    read_staticprop_lump(bsp_file)
-    read_entity_lump(bsp_file)  # this must come after read_staticprop_lump
-
-    bsp_file.close()
-
-    print("Finding dependencies...")
-
-    moreitems = True
-    while moreitems:
-        moreitems = False
-        for file, checked in list(dependencies.items()):
-            if any(r.match(file) is not None for r in dontpack):
-                del dependencies[file]
-                print("Skipping "+file)
-                continue
-            if checked == False:
-                newitems, deletethis = check_file(file)
-                dependencies[file] = True
-                for newitem in newitems:
-                    newitem = sanitize_filename(newitem)
-                    if not (newitem in dependencies):
-                        dependencies[newitem] = False
-                        moreitems = True
-                if deletethis:
-                    del dependencies[file]
-
-    for file, checked in list(dependencies.items()):
-        if file.startswith("maps/quickpacktemp"):
-            del dependencies[file]
-    delete_dir("maps/quickpacktemp")
-
-    filetypelist = {}
-    for file, checked in dependencies.items():
-        filetype = file.split(".", 1)[-1]
-        if filetype in filetypelist:
-            filetypelist[filetype] += 1
+    return mounts
+
+# A game's mounts and the indexes of their files, for packing any number of its maps. The indexes are
+# built once, and models and materials parsed for one map are reused for the next.
+# Packing a map only reads the indexes, but it does add to what's shared here, from each --jobs thread:
+# - studio_models and each StudioModel's skin_materials get single dict reads and writes with no lock. Two
+#   threads may parse the same file, with the same result.
+# - named_index is built once, under self.lock.
+# - the dependency cache's entries and changed files are updated under its own lock.
+# So maps can be packed from several threads at once. load_indexes (which replaces the indexes) and save_cache
+# must only run when no map is being packed.
+
+
+class Packer:
+    def __init__(self, gameroot, use_cache=True, check_vpks=False):
+        self.gameroot = os.path.abspath(gameroot)
+        # whether to look inside models and materials in vpks for more dependencies
+        self.check_vpks = check_vpks
+        # where to look for files
+        self.mounts = read_mounts(self.gameroot)
+        # folder for the indexes and parsed files cached between runs, or None
+        self.cache_folder = self.gameroot+"/"+cache_folder if use_cache else None
+        # StudioModels of the models parsed so far: absolute path->(size, mtime_ns, model)
+        self.studio_models = {}
+        # parsed materials and models from earlier runs (DependencyCache), or None
+        self.dependency_cache = None
+        if self.cache_folder is not None:
+            self.dependency_cache = DependencyCache(self.cache_folder+"/dependencies.sqlite")
+        # file lists of each mount and vpk, kept so indexing again only rescans what changed
+        self.mount_lists = {}
+        self.vpk_lists = {}
+        self.lock = threading.Lock()
+        self.load_indexes()
+
+    # Index the files of the mounts and vpks, reusing the lists of folders and vpks that haven't changed
+    # (from the cache, or from the last time this was called)
+    def load_indexes(self):
+        if self.cache_folder is None:
+            # relative path (lowercase)->(absolute path, size, mtime_ns when indexed) of the files in indexed folders
+            self.mount_index = build_mount_index(self.mounts, None, self.mount_lists)
+            # relative path (lowercase)->(dir vpk, archive index, offset, length, preload offset, preload length)
+            self.vpk_index = build_vpk_index(self.mounts, None, self.vpk_lists)
         else:
-            filetypelist[filetype] = 1
-
-    print("\nDone. Found custom content:")
-    for k, v in filetypelist.items():
-        print("    "+str(v)+" "+str(k)+" files.")
-
-    file_sizes.sort(key=lambda x: x[1], reverse=True)
-    first = True
-    for file, size in file_sizes:
-        size_kb = size//1000
-        if size_kb >= args.warn_filesize:
+            self.mount_index = build_mount_index(self.mounts, self.cache_folder+"/mounts.pickle", self.mount_lists)
+            self.vpk_index = build_vpk_index(self.mounts, self.cache_folder+"/vpks.pickle", self.vpk_lists)
+        # "particle:name", "soundscript:name" or "soundscape:name"->files it uses, made when first needed
+        self.named_index = None
+
+    # What a batch worker process needs to make a copy of this packer with from_shared
+    def shared(self):
+        return (self.gameroot, self.mounts, self.mount_index, self.vpk_index, self.check_vpks,
+                None if self.dependency_cache is None else self.dependency_cache.entries)
+
+    @classmethod
+    def from_shared(cls, shared):
+        packer = cls.__new__(cls)
+        packer.gameroot, packer.mounts, packer.mount_index, packer.vpk_index, packer.check_vpks, cache_entries = shared
+        packer.cache_folder = None
+        packer.studio_models = {}
+        packer.mount_lists = {}
+        packer.vpk_lists = {}
+        packer.lock = threading.Lock()
+        packer.named_index = None
+        packer.dependency_cache = None
+        if cache_entries is not None:
+            packer.dependency_cache = DependencyCache(None)
+            packer.dependency_cache.entries = cache_entries
+        return packer
+
+    # Files a "particle:", "soundscript:" or "soundscape:" name uses, from the particles and sound scripts in the mounts
+    def named_files(self, name):
+        with self.lock:
+            if self.named_index is None:
+                self.named_index = self.build_named_index()
+        return self.named_index.get(name, [])
+
+    # Parse every particle system file, soundscript and soundscape in the mounts (see script_locations) into one
+    # index. Like other files, names in a later mount override the same names in an earlier one.
+    def build_named_index(self):
+        index = {}
+        for m in self.mounts:
+            for kind, (pattern, manifest) in script_locations.items():
+                for path in self.script_files(m, pattern, manifest):
+                    try:
+                        parsed = self.parse_script(path, kind)
+                    except (OSError, ValueError, struct.error) as e:
+                        print("Warning: can't read "+path+" ("+str(e)+")")
+                        continue
+                    if kind == "pcf":
+                        for system in parsed["systems"]:
+                            index["particle:"+system.lower()] = [sanitize_filename(path[len(m)+1:])]
+                    else:
+                        for name, files in parsed.items():
+                            index[kind[:-1]+":"+name] = files
+        return index
+
+    # The files in a mount matching pattern, and the ones listed in its manifest that exist
+    def script_files(self, mount, pattern, manifest):
+        found = sorted(glob.glob(glob.escape(mount)+"/"+pattern, recursive=True))
+        manifest = mount+"/"+manifest
+        if os.path.isfile(manifest):
+            found.extend(mount+"/"+file for file in self.parse_script(manifest, "manifest")
+                         if os.path.isfile(mount+"/"+file))
+        return [path for path in dict.fromkeys(found) if path != manifest]
+
+    # Parse a particle system file or a script (see script_kind), or take it from the dependency cache if the
+    # file hasn't changed
+    def parse_script(self, absfile, kind):
+        stat = os.stat(absfile)
+        if self.dependency_cache is not None:
+            parsed = self.dependency_cache.get(absfile, stat.st_size, stat.st_mtime_ns)
+            if parsed is not None:
+                return parsed
+        parsed = read_script(absfile, kind)
+        if self.dependency_cache is not None:
+            self.dependency_cache.put(absfile, stat.st_size, stat.st_mtime_ns, parsed)
+        return parsed
+
+    # the mount a file on disk is in (the deepest one, since a mount can be inside another)
+    def mount_of(self, path):
+        return max((m for m in self.mounts if path.startswith(m+"/")), key=len, default=None)
+
+    # Pack a map of this game. options are from pack_options (or the command line). Returns a summary of
+    # what was packed, and raises PackError if packing failed.
+    def pack(self, abspath, options=None, profiler=None):
+        return PackContext(self, abspath, options or pack_options(), profiler).pack()
+
+    # Parse the static prop models and brush materials that more than one of the maps use, and everything they
+    # use, so they're in the dependency cache before --batch hands it to its workers. Maps that can't be read are
+    # left for their worker to report.
+    def parse_shared_content(self, abspaths, jobs=1):
+        contexts = []
+        used = collections.Counter()
+        for abspath in abspaths:
+            context = PackContext(self, abspath, pack_options())
+            try:
+                bsp = BspFile(abspath)
+            except (OSError, ValueError):
+                continue
+            try:
+                context.read_texture_lump(bsp)
+                context.read_staticprop_lump(bsp)
+            except (ValueError, struct.error):
+                continue
+            finally:
+                bsp.close()
+            contexts.append(context)
+            used.update(context.dependencies.keys())
+
+        shared = PackContext(self, abspaths[0], pack_options(jobs=jobs))
+        for context in contexts:
+            for file in context.dependencies:
+                if used[file] > 1 and not file.endswith(".mdl"):
+                    shared.add_dependency(file, "texture lump")
+            for prop, skins in context.model_skins.items():
+                if used[sanitize_filename(prop)] > 1:
+                    for skin in skins:
+                        shared.add_mdl_file(prop, skin, "static props")
+            for prop in context.all_model_skins:
+                if used[sanitize_filename(prop)] > 1:
+                    shared.add_mdl_file(prop, -1, "static props")
+        if len(shared.dependencies) > 0:
+            shared.resolve_dependencies("shared content", jobs)
+
+    # Write the files parsed since the last save to the cache
+    def save_cache(self):
+        if self.dependency_cache is not None:
+            self.dependency_cache.save()
+
+
+# Everything about packing one map: the files found so far and where they are, the skins used of each
+# model, and the map's exclusions. Made by Packer.pack.
+
+
+class PackContext:
+    def __init__(self, packer, abspath, options, profiler=None):
+        self.packer = packer
+        self.abspath = abspath
+        self.options = options
+        self.profiler = profiler or Profiler()
+        # dictionary mdlfile->set(skins) so we don't pack unused skins
+        self.model_skins = {}
+        # set of models we'll use every single skin on
+        self.all_model_skins = set()
+        # main file list (filename->boolean have we checked it for subdependencies)
+        self.dependencies = {}
+        # exclusion list of compiled regexes (from nopack.txt)
+        self.dontpack = []
+        # dependency graph of everything we checked (file->set(files it depends on)), starting at the map
+        self.dependency_graph = {}
+        # what first referenced each file found in the map itself, like "entity 12 prop_dynamic door1"
+        self.origins = {}
+        # file->what it was queued for first (a file, an origin, or the map), for the parents in the manifest
+        self.parents = {}
+        # sha1 of packed files that have been hashed
+        self.file_hashes = {}
+        # the map's embedded pakfile (lump 40), read in memory
+        self.pakfile = None
+        # compiler-generated patch materials in the pakfile (filename->ZipInfo)
+        self.pakfile_materials = {}
+        # relative path to absolute path
+        self.file_location = {}
+        # tuples of (filename, size)
+        self.file_sizes = []
+        # KeyValues tokens of the materials parsed while resolving dependencies, by absolute path, kept for
+        # minify_vmt so they aren't read and tokenized twice. None when not minifying.
+        self.vmt_tokens = {} if options.minify_vmt else None
+
+    def pack(self):
+        abspath = self.abspath
+        options = self.options
+        profiler = self.profiler
+        start = time.perf_counter()
+
+        error = map_path_error(abspath)
+        if error is not None:
+            raise PackError(error)
+        gameroot = os.path.dirname(os.path.dirname(abspath))
+        if os.path.normcase(gameroot) != os.path.normcase(self.packer.gameroot):
+            raise PackError("Packing failed: "+abspath+" isn't a map of "+self.packer.gameroot)
+
+        python_profile = None
+        if options.profile:
+            if options.profile_memory:
+                tracemalloc.start()
+            if options.profile_python:
+                python_profile = cProfile.Profile()
+                python_profile.enable()
+
+        # profiling is stopped even when packing fails, so it doesn't go on through the next map
+        try:
+            summary = self.pack_map(start)
+            if options.profile:
+                self.write_profile(python_profile)
+        finally:
+            if python_profile is not None:
+                python_profile.disable()
+            if options.profile and options.profile_memory and tracemalloc.is_tracing():
+                tracemalloc.stop()
+        return summary
+
+    # Find the map's dependencies and write them to its pakfile, once pack has checked the map and started profiling
+    def pack_map(self, start):
+        abspath = self.abspath
+        options = self.options
+        profiler = self.profiler
+
+        mapfilepath = "maps/"+os.path.basename(abspath).lower()
+        mapname = os.path.basename(abspath).lower().replace(".bsp", "")
+
+        # Add global dependencies to look for
+        dependencies = self.dependencies
+        dependencies["maps/"+mapname+".txt"] = False
+        dependencies["maps/"+mapname+".nav"] = False
+        dependencies["maps/"+mapname+".kv"] = False
+        dependencies["maps/cfg/"+mapname+".cfg"] = False
+        dependencies["resource/overviews/"+mapname+".txt"] = False
+        dependencies["resource/overviews/"+mapname+"_radar.dds"] = False
+        dependencies["resource/overviews/"+mapname+"_radar_spectate.dds"] = False
+        dependencies["resource/overviews/"+mapname+"_lower_radar.dds"] = False
+        dependencies["resource/overviews/"+mapname+"_higher_radar.dds"] = False
+        dependencies["maps/"+mapname+"_level_sounds.txt"] = False
+        dependencies["maps/"+mapname+"_particles.txt"] = False
+        dependencies["scripts/soundscapes_"+mapname+".txt"] = False
+
+        textfile_name = os.path.dirname(abspath)+"/"+mapname+".pack.txt"
+        if os.path.isfile(textfile_name):
+            print("\nAdding files from " +
+                  (sanitize_filename(textfile_name).split("/")[-1])+"...")
+            textfile = open(textfile_name, 'r', errors="replace")
+            textfilecontent = textfile.readlines()
+            textfile.close()
+            for i in textfilecontent:
+                self.add_dependency(sanitize_filename(i), mapname+".pack.txt")
+
+        textfile_name = os.path.dirname(abspath)+"/"+mapname+".nopack.txt"
+        if os.path.isfile(textfile_name):
+            print("\nRemoving files from " +
+                  (sanitize_filename(textfile_name).split("/")[-1])+"...")
+            textfile = open(textfile_name, 'r', errors="replace")
+            textfilecontent = textfile.readlines()
+            textfile.close()
+            for i in textfilecontent:
+                self.dontpack.append(re.compile("^"+i.strip()+"$"))
+
+        print("\nReading "+mapname+".bsp...")
+
+        try:
+            bsp = BspFile(abspath)
+        except (OSError, ValueError) as e:
+            raise PackError("Packing failed: "+str(e))
+
+        try:
+            with profiler.phase("pakfile lump"):
+                self.read_pakfile_lump(bsp)
+        except zipfile.BadZipFile as e:
+            bsp.close()
+            raise PackError("Packing failed: ERROR in pakfile of "+abspath+" ("+str(e)+")")
+
+        try:
+            with profiler.phase("texture lump"):
+                self.read_texture_lump(bsp)
+            with profiler.phase("static prop lump"):
+                self.read_staticprop_lump(bsp)
+            with profiler.phase("entity lump"):
+                self.read_entity_lump(bsp)  # this must come after read_staticprop_lump
+
+            print("Finding dependencies...")
+
+            with profiler.phase("resolve"):
+                self.resolve_dependencies(mapfilepath, options.jobs)
+        finally:
+            self.close_pakfile()
+            bsp.close()
+
+        if options.graph:
+            self.write_dependency_graph(options.graph, mapfilepath)
+
+        filetypelist = {}
+        for file, checked in dependencies.items():
+            filetype = file.split(".", 1)[-1]
+            if filetype in filetypelist:
+                filetypelist[filetype] += 1
+            else:
+                filetypelist[filetype] = 1
+
+        print("\nDone. Found custom content:")
+        for k, v in filetypelist.items():
+            print("    "+str(v)+" "+str(k)+" files.")
+
+        self.file_sizes.sort(key=lambda x: (-x[1], x[0]))
+        first = True
+        for file, size in self.file_sizes:
+            size_kb = size//1000
+            if size_kb >= options.warn_filesize:
+                if first:
+                    print("\nLarge files:")
+                    first = False
+                print("    {} is {} KB".format(file, size_kb))
+        if not first:
+            print("")
+
+        with profiler.phase("duplicates"):
+            self.report_duplicates()
+
+        compression = compression_methods[options.compress]
+        manifest = None
+        try:
+            if options.manifest:
+                manifest = Manifest(options.manifest, abspath)
+            pack_files = self.pack_sources(manifest)
+            if options.plan or options.max_size is not None:
+                pack_files = list(pack_files)
+                with profiler.phase("plan"):
+                    map_size, pakfile_size = self.plan(pack_files, compression)
+                if options.max_size is not None and map_size > options.max_size*1000:
+                    raise PackError("Packing failed: the map would be {} KB, more than --max-size {} KB".format(
+                        map_size//1000, options.max_size))
+            removed = ()
+            if options.plan:
+                print("\nDry run, "+abspath+" wasn't changed.")
+            else:
+                if options.incremental:
+                    with profiler.phase("incremental diff"):
+                        pack_files, removed, changelog, pakfile_size = diff_pakfile(abspath, pack_files, compression)
+                    if len(changelog) == 0:
+                        print("\nPakfile is up to date, nothing to write.")
+                    else:
+                        print("\nChanges to the pakfile:")
+                        for change, file in changelog:
+                            print("    {} {}".format(change, file))
+                if not options.incremental or len(changelog) > 0:
+                    print("\nWriting to "+abspath+"...")
+                    with profiler.phase("write"):
+                        pakfile_size, saved = write_pakfile(abspath, pack_files, removed, compression)
+                    profiler.count("bytes written", pakfile_size)
+                    if compression != zipfile.ZIP_STORED:
+                        print("Compression saved {} KB".format(saved//1000))
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            raise PackError("Packing failed: "+str(e))
+        finally:
+            if manifest is not None:
+                manifest.close()
+
+        if manifest is not None:
+            print("Wrote manifest of {} files to {}".format(manifest.count, options.manifest))
+        print("Done!")
+
+        return {"map": abspath, "files": len(dependencies), "bytes": sum(size for file, size in self.file_sizes),
+                "pakfile_bytes": pakfile_size, "seconds": round(time.perf_counter() - start, 3)}
+
+    # Print groups of packed files with the same content. Only files with the same size as another file are hashed.
+    def report_duplicates(self):
+        by_size = {}
+        for file, size in self.file_sizes:
+            if size > 0:
+                by_size.setdefault(size, []).append(file)
+
+        groups = {}
+        for size, files in by_size.items():
+            if len(files) > 1:
+                for file in files:
+                    groups.setdefault((size, self.packed_file_hash(file)), []).append(file)
+
+        wasted = 0
+        first = True
+        for (size, digest), files in sorted(groups.items(), key=lambda x: (-x[0][0], sorted(x[1]))):
+            if len(files) < 2:
+                continue
             if first:
-                print("\nLarge files:")
+                print("\nFiles with identical content:")
                 first = False
-            print("    {} is {} KB".format(file, size_kb))
-    if not first:
-        print("")
-
-    print("\nWriting to "+abspath+"...")
-
-    if args.minify_vmt:
-        delete_dir("quickpackmaterials")
-        os.mkdir("quickpackmaterials")
-
-    delete_file("quickpack.txt")
-
-    outfile = open("quickpack.txt", "w")
-    for file, checked in dependencies.items():
-        outfile.write(file+'\n')
-        if file.endswith(".vmt") and args.minify_vmt:
-            minify_vmt(file)
-            outfile.write(
-                (gameroot+"\\quickpack"+file).replace("/", "\\")+'\n')
+            print("    {} bytes each: {}".format(size, ", ".join(sorted(files))))
+            wasted += size * (len(files) - 1)
+        if not first:
+            print("    {} KB would be saved by using one copy of each\n".format(wasted//1000))
+
+    # Work out how big the pakfile and the map will be, without writing anything. Text files that will be compressed
+    # are compressed in memory (or a sample of them if they're big), and the entries already in the pakfile that
+    # will be kept are counted too. Prints the sizes by category, the biggest textures and what pulls in the most
+    # bytes. Returns the projected size of the map and of its pakfile.
+    def plan(self, pack_files, compression):
+        # category->[files, bytes, bytes in the pakfile]
+        categories = {}
+        # name->bytes in the pakfile of the files we're adding
+        packed = {}
+        pakfile_size = 22  # end of the central directory
+
+        def add(name, size, stored):
+            entry = categories.setdefault(plan_categories.get(name.rsplit(".", 1)[-1], "other"), [0, 0, 0])
+            entry[0] += 1
+            entry[1] += size
+            entry[2] += stored
+
+        for name, source in pack_files:
+            size = source_size(source)
+            stored = compressed_size(source, size, compress_type(name, size, compression))
+            packed[name] = stored
+            add(name, size, stored)
+            pakfile_size += stored + zip_entry_overhead(name, pack_marker)
+
+        bsp = BspFile(self.abspath)
+        try:
+            lump_offsets, pakfile_offset = lump_layout(bsp.lumps)
+            if len(bsp.lump(40)) > 0:
+                old_zip = zipfile.ZipFile(LumpReader(bsp.lump(40)))
+                for info in old_zip.infolist():
+                    name = sanitize_filename(info.filename)
+                    # replaced, or removed by --incremental
+                    if name in packed or (self.options.incremental and info.comment == pack_marker):
+                        continue
+                    add(name, info.file_size, info.compress_size)
+                    pakfile_size += info.compress_size + zip_entry_overhead(info.filename, info.comment, info.extra)
+                old_zip.close()
+                del old_zip
+        finally:
+            bsp.close()
+        map_size = pakfile_offset + pakfile_size
+
+        print("\nPakfile plan (compression: {}):".format(self.options.compress))
+        for category, (files, size, stored) in sorted(categories.items(), key=lambda x: (-x[1][2], x[0])):
+            print("    {:<12}{:>7} files {:>10} KB -> {:>10} KB".format(category, files, size//1000, stored//1000))
+        print("Projected pakfile {} KB, map {} KB".format(pakfile_size//1000, map_size//1000))
+
+        textures = sorted((x for x in pack_files if x[0].endswith(".vtf")), key=lambda x: (-packed[x[0]], x[0]))
+        shown = [x for i, x in enumerate(textures)
+                 if i < plan_top or packed[x[0]]//1000 >= self.options.warn_filesize]
+        if len(shown) > 0:
+            print("\nBiggest textures ({} of {}):".format(len(shown), len(textures)))
+        for name, source in shown:
+            try:
+                width, height, image_format, mips = read_vtf_header(source)
+                header = "{}x{} {}, {} mips".format(width, height, image_format, mips)
+            except (OSError, ValueError, struct.error) as e:
+                header = "can't read header ("+str(e)+")"
+            print("    {} is {} KB: {}".format(name, packed[name]//1000, header))
+
+        # bytes each entity (or lump...) pulls in, counting each file for the first one that used it
+        sources = collections.Counter()
+        for name, stored in packed.items():
+            chain = self.parent_chain(name)
+            sources[chain[0] if len(chain) > 0 else name] += stored
+        if len(sources) > 0:
+            print("\nWhat pulls in the most bytes:")
+        for source, stored in sorted(sources.items(), key=lambda x: (-x[1], x[0]))[:plan_top]:
+            print("    {}: {} KB".format(source, stored//1000))
+        return map_size, pakfile_size
+
+    # sha1 of a file we're packing, hashed once per map
+    def packed_file_hash(self, file):
+        digest = self.file_hashes.get(file)
+        if digest is None:
+            digest = self.file_hashes[file] = file_hash(self.file_location[file])
+        return digest
+
+    # Yield (name in the pakfile, source) for each file to pack. The source is the path of the file, or the
+    # minified content of a material, which is made as the pakfile is written rather than in a temp folder.
+    # Each file is added to manifest (a Manifest) as it's yielded.
+    def pack_sources(self, manifest=None):
+        for file in self.dependencies:
+            if self.vmt_tokens is not None and file.endswith(".vmt"):
+                with self.profiler.phase("minify"):
+                    source = self.minify_vmt(file)
+            else:
+                source = self.file_location[file]
+            if manifest is not None:
+                with self.profiler.phase("manifest"):
+                    manifest.add(self.manifest_entry(file, source))
+            yield file, source
+
+    # What the manifest says about a packed file. size and sha1 are of what goes in the pakfile.
+    def manifest_entry(self, file, source):
+        path = self.file_location[file]
+        if isinstance(source, bytes):
+            entry = {"file": file, "size": len(source), "sha1": hashlib.sha1(source).hexdigest(), "minified": True}
         else:
-            outfile.write(file_location[file].replace("/", "\\")+'\n')
-
-    outfile.close()
+            entry = {"file": file, "size": os.path.getsize(path), "sha1": self.packed_file_hash(file)}
+        entry["mount"] = self.packer.mount_of(path)
+        entry["source"] = path
+        entry["parents"] = self.parent_chain(file)
+        return entry
+
+    # What pulled a file in, outermost first, like ["entity 12 prop_dynamic door1", "models/door.mdl", "materials/door.vmt"]
+    def parent_chain(self, file):
+        chain = []
+        node = self.parents.get(file)
+        while node is not None:
+            chain.append(node)
+            node = self.parents.get(node)
+        chain.reverse()
+        return chain
+
+    # Check everything in dependencies (which are all unchecked), and everything they depend on.
+    # Each file is queued once, and exclusions are tested when it's queued.
+    # Afterwards dependencies only has the files we found and are going to pack.
+    # With more than one job, the whole queue is checked at once by a thread pool. Results are
+    # handled in queue order, so the output is the same as checking one file at a time.
+    def resolve_dependencies(self, root, jobs=1):
+        dependencies = self.dependencies
+        dependency_graph = self.dependency_graph
+        queue = collections.deque()
+        queued = set()
+
+        def enqueue(file, parent):
+            if file in queued:
+                dependency_graph[parent].add(file)
+                return
+            queued.add(file)
+            self.profiler.count("nopack regex tests", len(self.dontpack))
+            if any(r.match(file) is not None for r in self.dontpack):
+                print("Skipping "+file)
+                return
+            dependency_graph[parent].add(file)
+            dependency_graph[file] = set()
+            self.parents[file] = self.origins.get(file, parent) if parent == root else parent
+            queue.append(file)
+
+        dependency_graph[root] = set()
+        roots = list(dependencies)
+        dependencies.clear()
+        for file in roots:
+            enqueue(file, root)
+
+        executor = None
+        if jobs > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+        try:
+            while len(queue) > 0:
+                if executor is None:
+                    frontier = [queue.popleft()]
+                    results = map(self.check_file, frontier)
+                else:
+                    frontier = list(queue)
+                    queue.clear()
+                    results = executor.map(self.check_file, frontier)
+                for file, (newitems, deletethis) in zip(frontier, results):
+                    if not deletethis:
+                        dependencies[file] = True
+                    for newitem in newitems:
+                        enqueue(sanitize_filename(newitem), file)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    # Write the dependency graph as JSON, leaving out files that weren't found
+    def write_dependency_graph(self, filename, root):
+        found = set(self.dependencies).union(self.pakfile_materials)
+        found.update(name for name, children in self.dependency_graph.items()
+                     if ":" in name and not children.isdisjoint(found))
+        graph = {}
+        for file, children in self.dependency_graph.items():
+            if file in found or file == root:
+                graph[file] = sorted(children.intersection(found))
+        with open(filename, 'w') as outfile:
+            json.dump(graph, outfile, indent=1, sort_keys=True)
+
+    # Write the --profile report next to the map, with the slowest functions from cProfile and the biggest
+    # memory allocations if they were captured.
+    def write_profile(self, python_profile):
+        report = self.profiler.report()
+        report["map"] = self.abspath
+        report_base = self.abspath[:-4] + ".quickpack_profile"
+
+        if python_profile is not None:
+            python_profile.disable()
+            python_profile.dump_stats(report_base + ".prof")
+            stats = pstats.Stats(python_profile).stats
+            slowest = sorted(stats.items(), key=lambda x: -x[1][3])[:30]
+            report["python"] = {"stats": report_base + ".prof", "slowest": [
+                {"function": "{}:{}({})".format(*function), "calls": s[1], "time": round(s[2], 6),
+                 "cumulative": round(s[3], 6)} for function, s in slowest]}
+
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            biggest = tracemalloc.take_snapshot().statistics("lineno")[:20]
+            tracemalloc.stop()
+            report["memory"] = {"current_bytes": current, "peak_bytes": peak, "biggest": [
+                {"line": str(stat.traceback), "bytes": stat.size, "count": stat.count} for stat in biggest]}
+
+        with open(report_base + ".json", 'w') as outfile:
+            json.dump(report, outfile, indent=1)
+        print("Wrote profile to "+report_base+".json")
+
+    def check_file(self, filename):
+        packer = self.packer
+        profiler = self.profiler
+        filebase = filename.split(".", 1)[0]
+        filetype = filename.split(".", 1)[-1]
+        depends = []
+        deletethis = False
+
+        # Names of particle systems, soundscripts and soundscapes stand for the files they use
+        if ":" in filename:
+            profiler.count("named lookups")
+            return packer.named_files(filename), True
+
+        # Files that ship in the game's vpks never need packing, even if there's a loose copy
+        if filename in packer.vpk_index:
+            if packer.check_vpks and (filetype == "vmt" or filetype == "mdl"):
+                try:
+                    data = read_vpk_file(packer.vpk_index[filename])
+                    profiler.count("bytes read", len(data))
+                    if filetype == "vmt":
+                        depends = read_vmt(kv_tokens(data.decode("utf-8", "replace")))
+                    else:
+                        depends = self.mdl_materials(filename, StudioModel.from_bytes(data))
+                except (OSError, ValueError, struct.error) as e:
+                    print("Warning: can't read "+filename+" from vpk ("+str(e)+")")
+            return depends, True
+
+        profiler.count("files checked")
+        if filename.split("/", 1)[0] in indexed_folders:
+            profiler.count("mount index lookups")
+            if filename in packer.mount_index:
+                # only the path is used: a file can be overwritten without its folder's mtime changing,
+                # so the size in the index may be out of date
+                self.file_location[filename] = packer.mount_index[filename][0]
+        else:
+            profiler.count("files stat'ed", len(packer.mounts))
+            for m in packer.mounts:
+                absfile = m+"/"+filename
+                if os.path.isfile(absfile):
+                    self.file_location[filename] = absfile
+
+        # if file doesn't exist, we assume it's in a vpk so no need to pack
+        if filename in self.file_location:
+            absfile = self.file_location[filename]
+            profiler.count("files stat'ed")
+            self.file_sizes.append((filename, os.path.getsize(absfile)))
+            if filetype == "vmt":
+                depends = self.parse_file(absfile, filetype)
+
+            elif filetype == "mdl":
+                depends.append(filebase+".dx80.vtx")
+                depends.append(filebase+".dx90.vtx")
+                depends.append(filebase+".phy")
+                depends.append(filebase+".sw.vtx")
+                depends.append(filebase+".vvd")
+                try:
+                    depends.extend(self.mdl_materials(
+                        filename, self.parse_file(absfile, filetype)))
+                except (ValueError, struct.error) as e:
+                    print("Warning: can't read materials of "+absfile+" ("+str(e)+")")
+
+            elif script_kind(filename) is not None:
+                kind = script_kind(filename)
+                try:
+                    with profiler.phase("parse "+kind):
+                        depends = script_dependencies(kind, packer.parse_script(absfile, kind))
+                except (OSError, ValueError, struct.error) as e:
+                    print("Warning: can't read "+absfile+" ("+str(e)+")")
+
+        elif filename in self.pakfile_materials:
+            # Patch materials made by the compiler are already packed, but can reference other files
+            if filetype == "vmt":
+                content = self.pakfile.read(self.pakfile_materials[filename])
+                profiler.count("bytes read", len(content))
+                depends = read_vmt(kv_tokens(content.decode("utf-8", "replace")))
+            deletethis = True
 
-    os.system(bspzip_target + " -addlist "+mapfilepath_cmd +
-              " quickpack.txt "+mapfilepath_cmd + " > nul 2>&1")
+        else:
+            # It's not available, so don't try to pack it
+            deletethis = True
+
+        return depends, deletethis
+
+    # Parse a material or model on disk, or take it from the dependency cache if the file hasn't changed.
+    # Materials parse to a list of dependencies, and models to a StudioModel.
+    def parse_file(self, absfile, filetype):
+        packer = self.packer
+        profiler = self.profiler
+        profiler.count("files stat'ed")
+        stat = os.stat(absfile)
+        if filetype == "mdl":
+            known = packer.studio_models.get(absfile)
+            if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                profiler.count("models reused")
+                return known[2]
+
+        parsed = None
+        if packer.dependency_cache is not None:
+            parsed = packer.dependency_cache.get(
+                absfile, stat.st_size, stat.st_mtime_ns)
+            profiler.count("cache hits" if parsed is not None else "cache misses")
+            if parsed is not None and filetype == "mdl":
+                parsed = StudioModel.from_cache(parsed)
+
+        if parsed is None:
+            with profiler.phase("parse "+filetype):
+                if filetype == "vmt":
+                    file = open(absfile, 'r', errors="replace")
+                    content = file.read()
+                    file.close()
+                    profiler.count("bytes read", len(content))
+                    tokens = list(kv_tokens(content))
+                    parsed = read_vmt(tokens)
+                    if self.vmt_tokens is not None:
+                        self.vmt_tokens[absfile] = tokens
+                else:
+                    parsed = StudioModel.from_file(absfile, profiler)
+
+            if packer.dependency_cache is not None:
+                packer.dependency_cache.put(absfile, stat.st_size, stat.st_mtime_ns,
+                                            parsed.to_cache() if filetype == "mdl" else parsed)
+
+        if filetype == "mdl":
+            packer.studio_models[absfile] = (stat.st_size, stat.st_mtime_ns, parsed)
+        return parsed
+
+    # Find the materials used by the skins of a model we're packing.
+    def mdl_materials(self, filename, model):
+        if (filename in self.all_model_skins) or (filename not in self.model_skins):
+            return model.materials(-1)
+
+        depends = []
+        for skin in self.model_skins[filename]:
+            if skin >= 0 and skin < len(model.skins):
+                depends.extend(model.materials(skin))
+            else:
+                raise PackError("Invalid skin {} in {}!".format(skin, filename))
+        return list(dict.fromkeys(depends))
+
+    # Minify a material we're packing, returning the new content. Uses the tokens from when it was parsed if
+    # it wasn't taken from the dependency cache.
+    def minify_vmt(self, filename):
+        tokens = self.vmt_tokens.pop(self.file_location[filename], None)
+        if tokens is None:
+            file = open(self.file_location[filename], 'r', errors="replace")
+            content = file.read()
+            file.close()
+            self.profiler.count("bytes read", len(content))
+            tokens = list(kv_tokens(content))
+        return minify_tokens(tokens)
+
+    def read_texture_lump(self, bsp):
+        # Find (brush) Materials
+        for i in re.finditer(b'[^\0]+', bsp.lump(43)):
+            self.add_dependency(vmt_filename(i.group().decode("ascii")), "texture lump")
+
+    # Add staticprop mdl files into dependencies and add used skins to model_skins
+    def read_staticprop_lump(self, bsp):
+        if staticprop_lump_id not in bsp.game_lumps:
+            return
+        flags, lumpversion, lump = bsp.game_lumps[staticprop_lump_id]
+        counts = staticprop_counts(lump)
+        if counts is None:
+            print("Warning: static prop lump version {} is damaged, skipping static props".format(lumpversion))
+            return
+        dict_items, leafEntries, static_props, pos = counts
+        dict_start = 4
+        if static_props <= 0:
+            return
+
+        record_size = staticprop_record_size(
+            lumpversion, len(lump) - pos, static_props)
+        if record_size is None:
+            print("Warning: unknown static prop lump version {}, skipping static props".format(
+                lumpversion))
+            return
+
+        # every layout starts with origin, angles, then the model index at 24 and skin at 32
+        record = struct.Struct('<24xH6xi{}x'.format(record_size - 36))
+        props = set(record.iter_unpack(
+            lump[pos:pos + (record_size*static_props)]))
+        self.profiler.count("static props", static_props)
+
+        # model names are 128 byte entries
+        dict_data = lump[dict_start:dict_start + (128*dict_items)].tobytes()
+        names = {}
+        for modelid, skin in sorted(props):
+            if modelid not in names:
+                if modelid >= dict_items:
+                    print("Warning: invalid static prop model index {}".format(modelid))
+                    names[modelid] = None
+                    continue
+                try:
+                    names[modelid] = readcstr(dict_data, modelid*128, (modelid+1)*128)
+                except ValueError as e:
+                    print("Warning: invalid static prop model name {} ({})".format(modelid, e))
+                    names[modelid] = None
+                    continue
+            if names[modelid] is not None:
+                self.add_mdl_file(names[modelid], skin, "static props")
+
+    def read_entity_lump(self, bsp):
+        for index, ent in enumerate(read_entities(bsp.lump(0))):
+            self.profiler.count("entities")
+            origin = entity_origin(index, ent)
+            model = None
+            skin = -1
+            targetname = False
+            for k, v in ent:
+                kind = entity_key_kinds.get(k)
+                if kind == "model":
+                    model = v
+                elif kind == "skin":
+                    skin = v
+                elif kind == "targetname":
+                    targetname = True
+                elif kind == "material":
+                    self.add_dependency(vmt_filename(v), origin)
+                elif kind == "skybox":
+                    for side in ["bk", "dn", "ft", "lf", "rt", "up"]:
+                        self.add_dependency(vmt_filename("skybox/"+v+side), origin)
+                elif kind == "particle":
+                    self.add_dependency("particle:"+v, origin)
+                elif kind == "soundscape":
+                    self.add_dependency("soundscape:"+v, origin)
+                elif kind == "sound":
+                    v = v.lstrip(sound_chars)
+                    if v.endswith(".wav") or v.endswith(".ogg") or v.endswith(".mp3"):
+                        self.add_dependency(wave_filename(v), origin)
+                        continue
+                    elif v != "":
+                        # not a file, so it may be the name of a soundscript
+                        self.add_dependency("soundscript:"+v, origin)
+
+                # Find Sounds in any other key too (like outputs and commands)
+                if ".wav" in v or ".ogg" in v or ".mp3" in v:
+                    for i in sound_filename.findall(v):
+                        self.add_dependency(wave_filename(i), origin)
+
+            if model is not None and model != "" and model[0] != '*':
+                if model.endswith(".mdl"):
+                    # only pack this model's skin, UNLESS it has a targetname, in which case it might change
+                    try:
+                        skin = -1 if targetname else int(skin)
+                    except ValueError:
+                        skin = -1
+                    self.add_mdl_file(model, skin, origin)
+                else:
+                    # env_sprite uses "model" as the key for its material
+                    if model.endswith(".spr"):
+                        model = model[:-4]
+                    self.add_dependency(vmt_filename(model), origin)
+
+    # Open the embedded pakfile straight from the mapped lump and queue the patch materials made by the compiler
+    def read_pakfile_lump(self, bsp):
+        pakfile_lump = bsp.lump(40)
+        if len(pakfile_lump) == 0:
+            return
+        self.pakfile = zipfile.ZipFile(LumpReader(pakfile_lump))
+        for info in self.pakfile.infolist():
+            f = sanitize_filename(info.filename)
+            if f.startswith("materials/maps/"):
+                self.pakfile_materials[f] = info
+                self.add_dependency(f, "pakfile")
+
+    def close_pakfile(self):
+        if self.pakfile is not None:
+            self.pakfile.close()
+            self.pakfile = None
+
+    # queue a file the map uses, remembering the first origin (entity, lump...) that referenced it
+    def add_dependency(self, file, origin):
+        self.dependencies[file] = False
+        self.origins.setdefault(file, origin)
+
+    # add skin of prop (-1 for all skins)
+    def add_mdl_file(self, prop, skin, origin):
+        self.add_dependency(sanitize_filename(prop), origin)
+        if skin == -1:
+            self.all_model_skins.add(prop)
+        else:
+            if prop in self.model_skins:
+                self.model_skins[prop].add(skin)
+            else:
+                self.model_skins[prop] = set([skin])
+
+# Name an entity for the manifest by its place in the entity lump, class and targetname
+
+
+def entity_origin(index, ent):
+    name = "entity {}".format(index)
+    for key in ("classname", "targetname"):
+        for k, v in ent:
+            if k == key:
+                name += " "+v
+                break
+    return name
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Pack many maps at once with a process pool. Maps are grouped by game, and each game's mounts are indexed
+# once and handed to the workers along with the dependency cache. Content more than one map uses is parsed
+# first, so it's in the cache the workers get. Files the workers parse are merged back into the cache, which
+# is saved once per game.
+
+
+def pack_batch(args):
+    maps = []
+    for pattern in args.batch:
+        found = sorted(glob.glob(pattern)) or [pattern]
+        for mapfile in found:
+            abspath = os.path.abspath(mapfile)
+            if abspath not in maps:
+                maps.append(abspath)
+
+    games = {}
+    summaries = {}
+    for abspath in maps:
+        error = map_path_error(abspath)
+        if error is not None:
+            print(error)
+            summaries[abspath] = {"map": abspath, "failed": True}
+            continue
+        gameroot = os.path.dirname(os.path.dirname(abspath))
+        games.setdefault(gameroot, []).append(abspath)
+
+    processes = args.processes
+
+    for gameroot, game_maps in games.items():
+        print("\nPacking {} maps in {}...".format(len(game_maps), gameroot))
+        packer = Packer(gameroot, use_cache=not args.no_cache, check_vpks=args.check_vpks)
+        if len(game_maps) > 1 and processes > 1:
+            if packer.dependency_cache is None:
+                # hand what's parsed here to the workers, even if it isn't saved
+                packer.dependency_cache = DependencyCache(None)
+            print("Parsing the models and materials the maps share...")
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    packer.parse_shared_content(game_maps, args.jobs)
+            except PackError:
+                # like an invalid skin, which the map's worker reports
+                pass
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(processes, len(game_maps))),
+                                                    initializer=start_batch_worker,
+                                                    initargs=(packer.shared(), args)) as executor:
+            futures = [executor.submit(pack_batch_map, abspath)
+                       for abspath in game_maps]
+            for future in concurrent.futures.as_completed(futures):
+                log, summary, changed = future.result()
+                print("\n==== "+summary["map"]+" ====")
+                print(log.strip())
+                summaries[summary["map"]] = summary
+                if packer.dependency_cache is not None:
+                    packer.dependency_cache.merge(changed)
+        packer.save_cache()
+
+    summaries = [summaries[abspath] for abspath in maps]
+    print("\nBatch summary:")
+    for summary in summaries:
+        if summary.get("failed"):
+            print("    {}: FAILED".format(summary["map"]))
+        else:
+            print("    {}: {} files, {} KB packed, pakfile {} KB, {:.2f} s".format(
+                summary["map"], summary["files"], summary["bytes"]//1000, summary["pakfile_bytes"]//1000, summary["seconds"]))
+
+    if args.batch_summary:
+        with open(args.batch_summary, 'w') as outfile:
+            json.dump(summaries, outfile, indent=1)
+
+    # so scripts and CI can tell a map failed
+    if any(summary.get("failed") for summary in summaries):
+        sys.exit(1)
+
+# the packer and settings of the batch this worker process is packing maps for
+batch_packer = None
+batch_args = None
+
+
+def start_batch_worker(shared, args):
+    global batch_packer, batch_args
+    batch_packer = Packer.from_shared(shared)
+    batch_args = args
+
+# Pack a map in a batch worker. Returns what it printed, the summary, and the files it added to the cache.
+
+
+def pack_batch_map(abspath):
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        try:
+            summary = batch_packer.pack(abspath, batch_args)
+        except PackError as e:
+            print(str(e))
+            summary = {"map": abspath, "failed": True}
+        except Exception:
+            traceback.print_exc(file=log)
+            summary = {"map": abspath, "failed": True}
+    changed = {}
+    if batch_packer.dependency_cache is not None:
+        changed = batch_packer.dependency_cache.changed
+        batch_packer.dependency_cache.changed = {}
+    return log.getvalue(), summary, changed
+
+# Keep a game's indexes and parsed files in memory, and pack each map in its maps folder when the map changes.
+# A map is packed once it has stayed the same for watch_settle_time, and our own rewrite of it is ignored.
+# Before each map the indexes are brought up to date, and only the content files that changed are parsed again.
+
+
+def watch_maps(args):
+    folder = os.path.abspath(args.watch)
+    if not os.path.isdir(folder) or os.path.basename(folder).lower() != "maps":
+        print("Not a game's maps folder: "+folder)
+        sys.exit(1)
+
+    packer = Packer(os.path.dirname(folder), use_cache=not args.no_cache, check_vpks=args.check_vpks)
+    if packer.dependency_cache is None:
+        # keep parsed files in memory between maps, even if they aren't saved
+        packer.dependency_cache = DependencyCache(None)
+    watcher = FolderWatcher(folder)
+    # map->(size, mtime_ns) when it was last packed (or when we started)
+    known = map_stats(folder)
+    # changed map->((size, mtime_ns), when it was first seen like that)
+    pending = {}
+    print("\nWatching {} for changed maps ({}). Press Ctrl+C to stop.".format(
+        folder, "inotify" if watcher.fd is not None else "polling"))
+
+    try:
+        while True:
+            watcher.wait(watch_poll_interval if len(pending) > 0 or watcher.fd is None else watch_idle_timeout)
+            now = time.monotonic()
+            current = map_stats(folder)
+            for path, stat in current.items():
+                if stat == known.get(path):
+                    pending.pop(path, None)
+                elif path not in pending or pending[path][0] != stat:
+                    pending[path] = (stat, now)
+
+            for path in sorted(pending):
+                stat, since = pending[path]
+                if path not in current:
+                    del pending[path]
+                elif now - since >= watch_settle_time:
+                    del pending[path]
+                    print("\n==== "+path+" ====")
+                    profiler = Profiler()
+                    try:
+                        with profiler.phase("index"):
+                            packer.load_indexes()
+                        summary = packer.pack(path, args, profiler)
+                        print("Packed {} files in {:.2f} s".format(summary["files"], summary["seconds"]))
+                    except PackError as e:
+                        print(str(e))
+                    except Exception:
+                        traceback.print_exc()
+                    packer.save_cache()
+                    known[path] = map_stats(folder).get(path, stat)
+    except KeyboardInterrupt:
+        print("\nStopped watching "+folder)
+    finally:
+        watcher.close()
+        packer.save_cache()
+
+
+def map_stats(folder):
+    stats = {}
+    for entry in os.scandir(folder):
+        if entry.name.lower().endswith(".bsp"):
+            try:
+                stat = entry.stat()
+                stats[entry.path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+    return stats
+
+# Waits for something in a folder to change. Uses inotify (through ctypes) on Linux, which wakes up as soon as a
+# file is written. Elsewhere, or if inotify can't be used, it just sleeps and the folder is polled.
+
+
+class FolderWatcher:
+    def __init__(self, folder):
+        self.fd = None
+        if not sys.platform.startswith("linux"):
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        if libc.inotify_add_watch(fd, os.fsencode(folder), inotify_events) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        if len(select.select([self.fd], [], [], timeout)[0]) > 0:
+            # the events themselves don't matter, the folder is checked anyway
+            try:
+                while len(os.read(self.fd, 65536)) > 0:
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+# Index the files in each mount's indexed folders. Like before, a file in a later mount
+# overrides one in an earlier mount. Each mount's file list is kept in cache (mount->list, loaded
+# from cache_file if it's empty), and only the folders whose modification time changed are rescanned.
+
+
+def build_mount_index(mounts, cache_file=None, cache=None):
+    if cache is None:
+        cache = {}
+    if len(cache) == 0 and cache_file is not None and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                cache.update(pickle.load(f))
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, AttributeError):
+            print("Warning: ignoring unreadable cache "+cache_file)
+            cache.clear()
+
+    mount_index = {}
+    changed = False
+    for m in mounts:
+        if m not in cache:
+            print("Indexing "+m+"...")
+            cache[m] = index_mount(m)
+            changed = True
+        elif refresh_mount_index(m, cache[m]):
+            changed = True
+        mount_index.update(cache[m]["files"])
+
+    if cache_file is not None and changed:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, 'wb') as f:
+            pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+    return mount_index
+
+
+def dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Walk the indexed folders of a mount with os.scandir. Returns the files, and the folder
+# modification times the index depends on (including the mount itself if one of
+# the indexed folders is missing, in case it gets created).
+
+
+def index_mount(mount):
+    files = {}
+    dirs = {}
+    scan_folders([(mount+"/"+folder, folder) for folder in indexed_folders], files, dirs)
+    if any((mount+"/"+folder) not in dirs for folder in indexed_folders):
+        dirs[mount] = dir_mtime(mount)
+    return {"dirs": dirs, "files": files}
+
+# Bring a mount's index from index_mount up to date. Files are added, removed or renamed in a folder only when
+# its modification time changes, so only those folders are listed again (and any new folders in them).
+# Returns whether anything was rescanned.
+
+
+def refresh_mount_index(mount, index):
+    stale = [d for d, mtime in index["dirs"].items() if dir_mtime(d) != mtime]
+    if len(stale) == 0:
+        return False
+    if mount in index["dirs"]:
+        print("Indexing "+mount+"...")
+        index.update(index_mount(mount))
+        return True
+
+    print("Updating index of "+mount+" ({} folders changed)...".format(len(stale)))
+    stale_relpaths = dict((sanitize_filename(d[len(mount)+1:]), d) for d in stale)
+    files = index["files"]
+    for name in [name for name in files if name.rsplit("/", 1)[0] in stale_relpaths]:
+        del files[name]
+    for d in stale:
+        del index["dirs"][d]
+    scan_folders([(d, relpath) for relpath, d in stale_relpaths.items()], files, index["dirs"])
+    return True
+
+# List folders and the folders in them, adding their files and modification times to files and dirs.
+# Folders already in dirs aren't listed again. stack is a list of (path, relative path).
+
+
+def scan_folders(stack, files, dirs):
+    while len(stack) > 0:
+        path, relpath = stack.pop()
+        try:
+            dirs[path] = os.stat(path).st_mtime_ns
+            entries = list(os.scandir(path))
+        except OSError:
+            dirs.pop(path, None)
+            continue
+        for entry in entries:
+            name = relpath+"/"+entry.name.lower()
+            try:
+                if entry.is_dir():
+                    if entry.path not in dirs:
+                        stack.append((entry.path, name))
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files[name] = (entry.path, stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+
+
+# Index the files in the *_dir.vpk files in the game folder and the mounts. The file list of each vpk is kept
+# in cache (loaded from cache_file if it's empty) and reused until the vpk's size or modification time changes.
+
+
+def build_vpk_index(mounts, cache_file=None, cache=None):
+    if cache is None:
+        cache = {}
+    if len(cache) == 0 and cache_file is not None and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                cache.update(pickle.load(f))
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, AttributeError):
+            print("Warning: ignoring unreadable cache "+cache_file)
+            cache.clear()
+
+    vpk_index = {}
+    changed = False
+    for m in mounts:
+        for vpk in sorted(glob.glob(glob.escape(m)+"/*_dir.vpk")):
+            try:
+                stat = os.stat(vpk)
+                key = (stat.st_size, stat.st_mtime_ns)
+                if vpk not in cache or cache[vpk]["key"] != key:
+                    print("Indexing "+vpk+"...")
+                    cache[vpk] = {"key": key, "files": read_vpk_dir(vpk)}
+                    changed = True
+            except (OSError, ValueError, struct.error) as e:
+                print("Warning: can't read "+vpk+" ("+str(e)+")")
+                continue
+            for name, entry in cache[vpk]["files"].items():
+                vpk_index[name] = (vpk,) + entry
+
+    if cache_file is not None and changed:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, 'wb') as f:
+            pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+    return vpk_index
+
+# Read the directory tree of a vpk (version 1 or 2). Returns relative path (lowercase)->(archive index,
+# offset, length, preload offset, preload length). Files with archive index 0x7fff are in the dir vpk
+# itself, and their offset is already made relative to the start of the file. Only the header and the tree are
+# read, not the file data that can follow them.
+
+
+def read_vpk_dir(path):
+    with open(path, 'rb') as f:
+        data = f.read(12)
+        signature, version, tree_size = struct.unpack_from('<III', data, 0)
+        if signature != 0x55aa1234 or version not in (1, 2):
+            raise ValueError("not a vpk file")
+        tree_start = 12 if version == 1 else 28
+        data += f.read(tree_start - 12 + tree_size)
+    if len(data) != tree_start + tree_size:
+        raise ValueError("truncated vpk")
+    data_start = tree_start + tree_size
+
+    files = {}
+    pos = tree_start
+    while True:
+        end = data.index(b'\0', pos)
+        ext = data[pos:end].decode("utf-8", "replace")
+        pos = end+1
+        if ext == "":
+            break
+        while True:
+            end = data.index(b'\0', pos)
+            folder = data[pos:end].decode("utf-8", "replace")
+            pos = end+1
+            if folder == "":
+                break
+            while True:
+                end = data.index(b'\0', pos)
+                name = data[pos:end].decode("utf-8", "replace")
+                pos = end+1
+                if name == "":
+                    break
+                crc, preload, archive, offset, length, terminator = struct.unpack_from(
+                    '<IHHIIH', data, pos)
+                pos += 18
+                if archive == 0x7fff:
+                    offset += data_start
+                if ext != " ":
+                    name = name+"."+ext
+                if folder != " ":
+                    name = folder+"/"+name
+                files[sanitize_filename(name)] = (
+                    archive, offset, length, pos, preload)
+                pos += preload
+    return files
+
+# Read a whole file out of the vpks, given its entry in the vpk index
+
+
+def read_vpk_file(entry):
+    vpk, archive, offset, length, preload_offset, preload = entry
+    data = b''
+    if preload > 0:
+        with open(vpk, 'rb') as f:
+            f.seek(preload_offset)
+            data = f.read(preload)
+    if length > 0:
+        if archive != 0x7fff:
+            vpk = "{}_{:03d}.vpk".format(vpk[:-len("_dir.vpk")], archive)
+        with open(vpk, 'rb') as f:
+            f.seek(offset)
+            data += f.read(length)
+    if len(data) != preload+length:
+        raise ValueError("truncated vpk")
+    return data
 
-    delete_file("quickpack.txt")
-    if args.minify_vmt:
-        delete_dir("quickpackmaterials")
 
-    print("Done!")
+# Wall and CPU time of each step of packing a map, and counts of the work done, for --profile.
+# Steps can run more than once (or at once, with --jobs), and their times add up. CPU time is for the
+# whole process. Steps can also run inside other steps: files are minified and added to the manifest as they
+# are written or diffed, so that time is counted in "write" or "incremental diff" too.
+
+
+class Profiler:
+    def __init__(self):
+        self.start = (time.perf_counter(), time.process_time())
+        self.phases = {}
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            with self.lock:
+                entry = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+                entry["wall"] += wall
+                entry["cpu"] += cpu
+                entry["calls"] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def report(self):
+        return {"wall": round(time.perf_counter() - self.start[0], 6),
+                "cpu": round(time.process_time() - self.start[1], 6),
+                "phases": dict((name, {"wall": round(entry["wall"], 6), "cpu": round(entry["cpu"], 6),
+                                       "calls": entry["calls"]}) for name, entry in self.phases.items()),
+                "counters": dict(sorted(self.counters.items()))}
+
+# Writes a --manifest as a map is packed, one JSON object per packed file. A .jsonl file gets one object per line,
+# anything else a JSON document like {"map": ..., "files": [...]}. Entries are written as they're added, so
+# they aren't all kept in memory.
+
+
+class Manifest:
+    def __init__(self, path, map_path):
+        self.file = open(path, 'w')
+        self.lines = path.lower().endswith(".jsonl")
+        self.count = 0
+        if not self.lines:
+            self.file.write('{"map": '+json.dumps(map_path)+', "files": [')
+
+    def add(self, entry):
+        if self.lines:
+            self.file.write(json.dumps(entry)+"\n")
+        else:
+            self.file.write(("," if self.count > 0 else "")+"\n "+json.dumps(entry))
+        self.count += 1
+
+    def close(self):
+        if not self.lines:
+            self.file.write("\n]}\n")
+        self.file.close()
+
+# Parsed materials and models from earlier runs, stored in SQLite and keyed by (absolute path, size, mtime_ns).
+# Everything is loaded up front so lookups don't touch the database (and work from any thread).
+# When saving, the least recently used files beyond max_entries are dropped.
+
+
+class DependencyCache:
+    version = 2
+
+    def __init__(self, path, max_entries=200000):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        self.changed = {}
+        self.lock = threading.Lock()
+        self.now = int(time.time())
+        if path is None or not os.path.isfile(path):
+            return
+        try:
+            db = sqlite3.connect(path)
+            try:
+                if db.execute("PRAGMA user_version").fetchone()[0] == self.version:
+                    for row in db.execute("SELECT path, size, mtime, data, last_used FROM files"):
+                        self.entries[row[0]] = row[1:]
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            print("Warning: ignoring unreadable cache "+path+" ("+str(e)+")")
+            self.entries = {}
+
+    def get(self, path, size, mtime):
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != size or entry[1] != mtime:
+            return None
+        with self.lock:
+            self.changed[path] = (size, mtime, entry[2], self.now)
+        return json.loads(entry[2])
+
+    def put(self, path, size, mtime, parsed):
+        entry = (size, mtime, json.dumps(parsed), self.now)
+        with self.lock:
+            self.entries[path] = entry
+            self.changed[path] = entry
+
+    # add files parsed by another process
+    def merge(self, changed):
+        with self.lock:
+            self.entries.update(changed)
+            self.changed.update(changed)
+
+    # write new and used files to the database (unless this is a copy in a batch worker, with no path)
+    def save(self):
+        if self.path is None or len(self.changed) == 0:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path)
+            try:
+                if db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+                    db.execute("DROP TABLE IF EXISTS files")
+                    db.execute(
+                        "PRAGMA user_version = {}".format(self.version))
+                db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, "
+                           "mtime INTEGER, data TEXT, last_used INTEGER)")
+                db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                               ((path,) + entry for path, entry in self.changed.items()))
+                db.execute("DELETE FROM files WHERE path IN (SELECT path FROM files "
+                           "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+                db.commit()
+            finally:
+                db.close()
+            self.changed = {}
+        except sqlite3.Error as e:
+            print("Warning: can't write cache "+self.path+" ("+str(e)+")")
 
 
 def debug_bytes(bytes):
@@ -257,29 +1805,61 @@ def debug_bytes(bytes):
     return
 
 
-def shlex_split_comments(txt):
-    nxt = ""
-    for ln in txt.split("\n"):
-        nxt += ln.split("//")[0]+" "
-    return shlex.split(nxt)
+# KeyValues tokens (vmt, mount.cfg and other script files). Whitespace and // comments are skipped,
+# quoted strings end at the closing quote or the end of the line, and [$X360] style conditionals are
+# kept separate so they can be ignored.
+kv_token = re.compile(
+    r'\s+|//[^\n]*|"([^"\n]*)"?|([{}])|(\[[^\]\n]*\])|((?:[^\s"{}/]|/(?!/))+)')
 
+# kinds of tokens from kv_tokens
+KV_QUOTED = 1
+KV_BRACE = 2
+KV_CONDITIONAL = 3
+KV_WORD = 4
 
-def regex_find(regex, data):
-    regex = re.compile(regex, re.IGNORECASE)
-    data = re.findall(regex, data)
-    data = set(list(map(lambda x: sanitize_filename(x), data)))
-    return data
+
+def kv_tokens(text):
+    for match in kv_token.finditer(text):
+        kind = match.lastindex
+        if kind is not None:
+            yield kind, match.group(kind)
+
+# Yield (block path, key, value) for each key/value pair in KeyValues tokens (from kv_tokens), at any depth.
+# The block path is a tuple of the names of the blocks the pair is in, like ("patch", "replace").
+
+
+def kv_pairs(tokens):
+    path = ()
+    key = None
+    for kind, token in tokens:
+        if kind == KV_BRACE:
+            if token == "{":
+                path = path + (key,)
+            else:
+                path = path[:-1]
+            key = None
+        elif kind == KV_CONDITIONAL:
+            continue
+        elif key is None:
+            key = token
+        else:
+            yield path, key, token
+            key = None
 
 
-def readcstr(f):
-    toeof = iter(functools.partial(f.read, 1), b'')
-    return (b''.join(itertools.takewhile(b'\0'.__ne__, toeof))).decode("utf-8")
+# read a null-terminated string at offset in a block of bytes that was read in one go. The strings are from files
+# that can be corrupt, so it raises ValueError on offsets and strings outside of the data (or before end).
 
 
-def cmd_path(p):
-    if (' ' in p) and (not ('"' in p)):
-        p = '"'+p+'"'
-    return p.replace("/", "\\")
+def readcstr(data, offset, end=None):
+    if end is None or end > len(data):
+        end = len(data)
+    if offset < 0 or offset >= end:
+        raise ValueError("string offset {} out of range".format(offset))
+    nul = data.find(b'\0', offset, end)
+    if nul == -1:
+        raise ValueError("unterminated string at offset {}".format(offset))
+    return data[offset:nul].decode("utf-8")
 
 
 def delete_file(f):
@@ -287,11 +1867,6 @@ def delete_file(f):
         os.remove(f)
 
 
-def delete_dir(f):
-    if os.path.isdir(f):
-        shutil.rmtree(f)
-
-
 def vtf_filename(file):
     file = "materials/" + sanitize_filename(file)
     if not file.endswith(".vtf"):
@@ -306,6 +1881,10 @@ def vmt_filename(file):
     return file
 
 
+def wave_filename(wave):
+    return "sound/" + sanitize_filename(wave.lstrip(sound_chars))
+
+
 def sanitize_filename(file):
     return file.lower().replace("\\", "/").strip().strip("/")
 
@@ -313,300 +1892,722 @@ def sanitize_filename(file):
 unquotable = re.compile("^[a-z0-9$.]+$")
 
 
-def minify_vmt(filename):
-    file = open(file_location[filename], 'r')
-    content = file.read().strip()
-    file.close()
+# keys minify_vmt leaves out (they're only used by hammer)
+minify_skip_keys = set(["%keywords", "%tooltexture"])
 
-    nxt = ""
-    for ln in content.split("\n"):
-        words = ln.lower().split("//")[0].strip().split()
-        words = [word[1:-1] if word[0] == '"' and word[-1]
-                 == '"' and unquotable.match(word[1:-1]) else word for word in words]
-        if len(words) > 0 and words[0].lower() in ["%keywords", "%tooltexture"]:
-            continue
-        ln = " ".join(words)
-        if ln != "":
-            nxt += ln + "\n"
 
-    outfile = "quickpack"+filename
-    os.makedirs("/".join(outfile.split("/")[:-1]), exist_ok=True)
-    with open(outfile, "w") as outf:
-        outf.write(nxt)
+# Minify the KeyValues tokens of a material, returning the new content
 
 
-def check_file(filename):
-    filebase = filename.split(".", 1)[0]
-    filetype = filename.split(".", 1)[-1]
+def minify_tokens(tokens):
+    # one key/value pair or brace per line, only quoting strings that need it
+    lines = []
+    line = []
+    strings = 0
+    for kind, token in tokens:
+        if kind == KV_BRACE:
+            if len(line) > 0:
+                lines.append(line)
+            lines.append([token])
+            line = []
+            strings = 0
+        elif kind == KV_CONDITIONAL:
+            if len(line) == 0 and len(lines) > 0:
+                lines[-1].append(token)
+            else:
+                line.append(token)
+        else:
+            if strings == 2:
+                lines.append(line)
+                line = []
+                strings = 0
+            token = token.lower()
+            if not unquotable.match(token):
+                token = '"'+token+'"'
+            line.append(token)
+            strings += 1
+    if len(line) > 0:
+        lines.append(line)
+
+    nxt = ""
+    for words in lines:
+        if words[0].strip('"') not in minify_skip_keys:
+            nxt += " ".join(words) + "\n"
+    return nxt.encode("utf-8")
+
+# The texture names, texture dirs and the textures used by each skin of a model (mdl). Only the header, skin
+# table, texture entries and their names are read, not the whole file. The materials each skin uses are
+# worked out once per model.
+
+
+class StudioModel:
+    def __init__(self, textures, dirs, refs, skins):
+        self.textures = textures
+        self.dirs = dirs
+        self.refs = refs
+        self.skins = skins
+        self.skin_materials = {}
+
+    @classmethod
+    def from_file(cls, path, profiler=None):
+        with open(path, 'rb') as file:
+            def read(offset, size):
+                file.seek(offset)
+                data = file.read(size)
+                if profiler is not None:
+                    profiler.count("bytes read", len(data))
+                return data
+            return cls.read(read)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls.read(lambda offset, size: data[offset:offset+size])
+
+    # read(offset, size) returns up to size bytes of the file at offset
+    @classmethod
+    def read(cls, read):
+        header = read(204, 28)
+        if len(header) < 28:
+            raise ValueError("truncated mdl header")
+        texture_count, texture_offset, texturedir_count, texturedir_offset, skinreference_count, skinrfamily_count, skinreference_index = struct.unpack(
+            '<7i', header)
+        if min(texture_count, texturedir_count, skinreference_count, skinrfamily_count) < 0:
+            raise ValueError("negative count in mdl header")
+
+        # the skin table is stored one family after another
+        skins = array.array('H')
+        skin_data = read(skinreference_index, 2*skinreference_count*skinrfamily_count)
+        if len(skin_data) < 2*skinreference_count*skinrfamily_count:
+            raise ValueError("truncated mdl skin table")
+        skins.frombytes(skin_data)
+        if sys.byteorder == "big":
+            skins.byteswap()
+
+        # Thanks to ZeqMacaw for helping figure this part out (filtering skin table columns)
+        last_column = 0
+        unseen_indexes = set(range(skinreference_count))
+        for x in range(skinreference_count):
+            column = skins[x::skinreference_count]
+            for index in column:
+                if index != column[0]:
+                    last_column = x
+                if index in unseen_indexes:
+                    last_column = x
+                    unseen_indexes.remove(index)
+
+        skin_to_textures = [sorted(set(skins[skin*skinreference_count:skin*skinreference_count+last_column+1]))
+                            for skin in range(skinrfamily_count)]
+
+        # texture entries are 64 bytes, starting with the offset of the name from the entry.
+        # The names are usually next to each other, so they're read in one go.
+        entries = read(texture_offset, texture_count*64)
+        dir_data = read(texturedir_offset, texturedir_count*4)
+        if len(entries) < texture_count*64 or len(dir_data) < texturedir_count*4:
+            raise ValueError("truncated mdl texture table")
+        name_offsets = [texture_offset + (tex_id*64) + struct.unpack_from('<i', entries, tex_id*64)[0]
+                        for tex_id in range(texture_count)]
+        dir_offsets = list(struct.unpack('<{}i'.format(texturedir_count), dir_data))
+        strings_offset = min(name_offsets + dir_offsets, default=0)
+        if strings_offset < 0:
+            raise ValueError("string offset {} out of range".format(strings_offset))
+        strings = read(strings_offset, max(name_offsets + dir_offsets, default=0) - strings_offset + 260)
+
+        textures = [readcstr(strings, offset - strings_offset) for offset in name_offsets]
+        texturedirs = [readcstr(strings, offset - strings_offset) for offset in dir_offsets]
+        return cls(textures, texturedirs, skinreference_count, skin_to_textures)
+
+    @classmethod
+    def from_cache(cls, entry):
+        return cls(entry["textures"], entry["dirs"], entry["refs"], entry["skins"])
+
+    def to_cache(self):
+        return {"textures": self.textures, "dirs": self.dirs, "refs": self.refs, "skins": self.skins}
+
+    # material filenames used by a skin (-1 for all skins). If for some reason there are multiple
+    # texturedirs, just look for all combinations
+    def materials(self, skin):
+        found = self.skin_materials.get(skin)
+        if found is None:
+            used = range(self.refs) if skin == -1 else self.skins[skin]
+            textures = [self.textures[tex_id] for tex_id in sorted(set(used)) if tex_id < len(self.textures)]
+            found = [vmt_filename(tdir+tex) for tdir in self.dirs for tex in textures]
+            self.skin_materials[skin] = found
+        return found
+
+
+# Find the textures and materials a material uses, in any block (including patch and proxy blocks)
+
+
+def read_vmt(tokens):
     depends = []
-    deletethis = False
+    for path, key, value in kv_pairs(tokens):
+        key = key.lower()
+        value = value.lower()
+        if key.replace("2", "") in vtf_keys:
+            depends.append(vtf_filename(value))
+        elif key in vmt_keys:
+            depends.append(vmt_filename(value))
+        elif key == "include":
+            depends.append(value)
+    return depends
+
+# What kind of script a file is, for read_script, or None. The map's own sound, soundscape and particle
+# scripts are loaded by the engine along with it. Manifests are checked first: game_sounds_manifest.txt and
+# soundscapes_manifest.txt also look like soundscripts and soundscapes, and the dependency cache only keeps
+# one parse of each file.
+
+
+def script_kind(filename):
+    if filename.endswith(".pcf"):
+        return "pcf"
+    manifests = [manifest for pattern, manifest in script_locations.values()]
+    if filename.endswith("_particles.txt") or filename in manifests:
+        return "manifest"
+    if filename.startswith("scripts/soundscapes_"):
+        return "soundscapes"
+    if filename.startswith("scripts/game_sounds") or filename.endswith("_level_sounds.txt"):
+        return "soundscripts"
+    return None
+
+# Parse a script file. pcf files parse to {"systems": [...], "materials": [...]}, soundscripts and soundscapes
+# to name->files it uses, and manifests to the files they list.
+
+
+def read_script(absfile, kind):
+    if kind == "pcf":
+        with open(absfile, 'rb') as file:
+            systems, materials = read_pcf(file.read())
+        return {"systems": systems, "materials": materials}
+    file = open(absfile, 'r', errors="replace")
+    content = file.read()
+    file.close()
+    tokens = kv_tokens(content)
+    if kind == "soundscripts":
+        return read_soundscripts(tokens)
+    if kind == "soundscapes":
+        return read_soundscapes(tokens)
+    return read_script_manifest(tokens)
 
-    for m in mounts:
-        absfile = m+"/"+filename
-        if os.path.isfile(absfile):
-            file_location[filename] = absfile
-
-    # if file doesn't exist, we assume it's in a vpk so no need to pack
-    if filename in file_location:
-        absfile = file_location[filename]
-        file_sizes.append((filename, os.path.getsize(absfile)))
-        if filetype == "vmt":
-            file = open(absfile, 'r')
-            content = file.read().lower().strip()
-            try:
-                content = shlex_split_comments(content)
-            except ValueError as e:
-                print("Packing failed: ERROR in file: "+absfile+" ("+str(e)+")")
-                sys.exit()
-            while len(content) >= 2:
-                key = content.pop(0)
-                if key.replace("2", "") in vtf_keys:
-                    depends.append(vtf_filename(content.pop(0)))
-                elif key in vmt_keys:
-                    depends.append(vmt_filename(content.pop(0)))
-                elif key == "include":
-                    depends.append(content.pop(0))
-            file.close()
+# the files a parsed script file uses
 
-        elif filetype == "mdl":
-            depends.append(filebase+".dx80.vtx")
-            depends.append(filebase+".dx90.vtx")
-            depends.append(filebase+".phy")
-            depends.append(filebase+".sw.vtx")
-            depends.append(filebase+".vvd")
-            file = open(absfile, 'rb')
-            file.seek(204)
-            texture_count, = struct.unpack('<i', file.read(4))
-            texture_offset, = struct.unpack('<i', file.read(4))
-            texturedir_count, = struct.unpack('<i', file.read(4))
-            texturedir_offset, = struct.unpack('<i', file.read(4))
-            skinreference_count, = struct.unpack('<i', file.read(4))
-            skinrfamily_count, = struct.unpack('<i', file.read(4))
-            skinreference_index, = struct.unpack('<i', file.read(4))
-
-            used_materials = set()
-
-            if (filename in all_model_skins) or (filename not in model_skins):
-                used_materials = set([x for x in range(skinreference_count)])
-            else:
-                file.seek(skinreference_index)
-                this_skinreference = 0
-                this_skinfamily = 0
-                skins_to_read = skinreference_count*skinrfamily_count
-
-                skintable = [[0 for y in range(skinrfamily_count)]
-                             for x in range(skinreference_count)]
-                while skins_to_read > 0:
-                    next, = struct.unpack('<H', file.read(2))
-                    skintable[this_skinreference][this_skinfamily] = next
-                    this_skinreference = this_skinreference+1
-                    if this_skinreference >= skinreference_count:
-                        this_skinreference = 0
-                        this_skinfamily = this_skinfamily+1
-                    skins_to_read = skins_to_read-1
-
-                # Thanks to ZeqMacaw for helping figure this part out (filtering skin table columns)
-                last_different_column = 0
-                last_newindex_column = 0
-                unseen_indexes = set([x for x in range(skinreference_count)])
-                for x in range(skinreference_count):
-                    for y in range(skinrfamily_count):
-                        if skintable[x][0] != skintable[x][y]:
-                            last_different_column = x
-                        if skintable[x][y] in unseen_indexes:
-                            last_newindex_column = x
-                            unseen_indexes.remove(skintable[x][y])
-
-                last_column = max(last_different_column, last_newindex_column)
-
-                skin_to_textures = {}
-                for skin in range(skinrfamily_count):
-                    skin_to_textures[skin] = set()
-                    for x in range(last_column+1):
-                        skin_to_textures[skin].add(skintable[x][skin])
-
-                for skin in model_skins[filename]:
-                    if skin in skin_to_textures:
-                        for i in skin_to_textures[skin]:
-                            used_materials.add(i)
-                    else:
-                        print("Invalid skin {} in {}!".format(skin, filename))
-                        sys.exit()
-
-            textureoffsets = []
-            file.seek(texture_offset)
-            tex_id = 0
-            while texture_count > 0:
-                next, = struct.unpack('<i', file.read(4))
-                name_spot = file.tell()-4+next
-                file.seek(file.tell()+60)
-                texture_count = texture_count - 1
-                if tex_id in used_materials:
-                    textureoffsets.append(name_spot)
-                tex_id = tex_id + 1
-            texturediroffsets = []
-            file.seek(texturedir_offset)
-            while texturedir_count > 0:
-                next, = struct.unpack('<i', file.read(4))
-                texturediroffsets.append(next)
-                texturedir_count = texturedir_count - 1
-            textures = []
-            for offset in textureoffsets:
-                file.seek(offset)
-                textures.append(readcstr(file))
-            texturedirs = []
-            # If for some reason there are multiple texturedirs, just look for all combinations
-            for offset in texturediroffsets:
-                file.seek(offset)
-                tdir = readcstr(file)
-                for tex in textures:
-                    depends.append(vmt_filename(tdir+tex))
 
-            file.close()
+def script_dependencies(kind, parsed):
+    if kind == "pcf":
+        return parsed["materials"]
+    if kind == "manifest":
+        return parsed
+    return [file for files in parsed.values() for file in files]
+
+# The sound files of each soundscript, including the ones in rndwave blocks
+
+
+def read_soundscripts(tokens):
+    sounds = {}
+    for path, key, value in kv_pairs(tokens):
+        if len(path) > 0 and key.lower() == "wave":
+            sounds.setdefault(path[0].lower(), []).append(wave_filename(value))
+    return sounds
+
+# The sound files of each soundscape, and the soundscapes it plays (as "soundscape:name")
+
+
+def read_soundscapes(tokens):
+    soundscapes = {}
+    for path, key, value in kv_pairs(tokens):
+        key = key.lower()
+        if len(path) == 0:
+            continue
+        if key == "wave":
+            soundscapes.setdefault(path[0].lower(), []).append(wave_filename(value))
+        elif key == "name" and path[-1].lower() == "playsoundscape":
+            soundscapes.setdefault(path[0].lower(), []).append("soundscape:"+value.lower())
+    return soundscapes
 
+# The files listed in a manifest (particles_manifest.txt, game_sounds_manifest.txt, a map's _particles.txt...)
+
+
+def read_script_manifest(tokens):
+    return [sanitize_filename(value.lstrip("!")) for path, key, value in kv_pairs(tokens) if len(path) > 0]
+
+# Read the particle system names and the materials in a binary DMX particle file (pcf). The string table and the
+# element headers (type and name) are parsed. Materials are found as "material" string attributes, and as
+# strings in the table ending in .vmt (newer versions store attribute strings there).
+
+
+def read_pcf(data):
+    match = dmx_header.match(data)
+    if match is None:
+        raise ValueError("not a binary dmx file")
+    version = int(match.group(1))
+    for layout in dmx_layouts(version):
+        try:
+            strings, elements = read_dmx_elements(data, match.end(), version, *layout)
+            break
+        except (ValueError, IndexError, struct.error):
+            continue
+    else:
+        raise ValueError("can't read dmx version {} elements".format(version))
+
+    systems = [name for type_name, name in elements if type_name == "DmeParticleSystemDefinition"]
+    materials = [s for s in strings if s.lower().endswith(".vmt")]
+    if version < 2:
+        attribute = b'material\0'
+    elif "material" in strings:
+        attribute = struct.pack(layout[1], strings.index("material"))
     else:
-        # It's not available, so don't try to pack it
-        deletethis = True
-
-    return depends, deletethis
-
-
-def read_texture_lump(bsp_file):
-    texturelump = read_lump(bsp_file, 43)
-
-    # Find (brush) Materials
-    maptextures = texturelump.split(b'\0')[:-1]
-
-    for i in maptextures:
-        dependencies[vmt_filename(i.decode("ascii"))] = False
-
-# Add staticprop mdl files into dependencies and add used skins to model_skins
-
-
-def read_staticprop_lump(bsp_file):
-    bsp_file.seek(8 + (35*16))
-    fileofs, = struct.unpack('<i', bsp_file.read(4))
-    filelen, = struct.unpack('<i', bsp_file.read(4))
-    bsp_file.seek(fileofs)
-    lumpcount, = struct.unpack('<i', bsp_file.read(4))
-    while lumpcount > 0:
-        lumpcount = lumpcount - 1
-        lumpid, = struct.unpack('<i', bsp_file.read(4))
-        bsp_file.seek(bsp_file.tell()+2)
-        lumpversion, = struct.unpack('<H', bsp_file.read(2))
-        fileofs, = struct.unpack('<i', bsp_file.read(4))
-        filelen, = struct.unpack('<i', bsp_file.read(4))
-        last_pos = bsp_file.tell()
-        # static prop lump
-        if lumpid == 1936749168:
-            bsp_file.seek(fileofs)
-            dict_items, = struct.unpack('<i', bsp_file.read(4))
-            bsp_file.seek(128*dict_items, 1)
-            leafEntries, = struct.unpack('<i', bsp_file.read(4))
-            bsp_file.seek(2*leafEntries, 1)
-            static_props, = struct.unpack('<i', bsp_file.read(4))
-            staticpropstart = bsp_file.tell()
-            while static_props > 0:
-                static_props = static_props - 1
-                bsp_file.seek(24, 1)
-                modelid, = struct.unpack('<H', bsp_file.read(2))
-                bsp_file.seek(6, 1)
-                skin, = struct.unpack('<i', bsp_file.read(4))
-                bsp_file.seek(20, 1)
-                if lumpversion >= 5:
-                    bsp_file.seek(4, 1)
-                if lumpversion == 6 or lumpversion == 7 or lumpversion == 8:
-                    bsp_file.seek(4, 1)
-                if lumpversion >= 7:
-                    bsp_file.seek(4, 1)
-                if lumpversion >= 10:
-                    bsp_file.seek(4, 1)
-                # Might be incorrect. It's a bool, but I think it's aligned to take up 4 bytes.
-                if lumpversion >= 9:
-                    bsp_file.seek(4, 1)
-                staticpropstart = bsp_file.tell()
-                bsp_file.seek(fileofs + 4 + (modelid*128))
-                prop = readcstr(bsp_file)
-
-                add_mdl_file(prop, skin)
-                bsp_file.seek(staticpropstart)
-        bsp_file.seek(last_pos)
-
-
-def read_entity_lump(bsp_file):
-    entitylump = read_lump(bsp_file, 0).decode("utf-8")
-    entity_list = []
-    this_entity = {}
-    for line in entitylump.split('\n')[:-1]:
-        line = line.strip()
-        if line == "{":
+        attribute = None
+    if attribute is not None:
+        # the attribute's name, its type (5 is a string) and the string
+        for value in re.finditer(re.escape(attribute + b'\x05') + b'([^\0]+)\0', data):
+            materials.append(value.group(1).decode("utf-8", "replace"))
+    return systems, list(dict.fromkeys(vmt_filename(material) for material in materials))
+
+# Ways the string table and its indexes may be stored for a binary DMX version: (struct format of the number of
+# strings, of a string index, whether element names are in the table). They differ between versions and
+# branches, so each is tried until the element headers make sense.
+
+
+def dmx_layouts(version):
+    if version < 2:
+        return [(None, None, False)]
+    return [(count, index, version >= 4) for count, index in (('<i', '<H'), ('<H', '<H'), ('<i', '<i'))]
+
+# Read the string table and the (type, name) of each element. Raises ValueError if they don't make sense.
+
+
+def read_dmx_elements(data, pos, version, count_format, index_format, names_in_table):
+    def read_string():
+        nonlocal pos
+        end = data.index(b'\0', pos)
+        string = data[pos:end].decode("utf-8", "replace")
+        pos = end + 1
+        return string
+
+    def read_format(fmt):
+        nonlocal pos
+        value, = struct.unpack_from(fmt, data, pos)
+        pos += struct.calcsize(fmt)
+        return value
+
+    strings = []
+    if version >= 2:
+        string_count = read_format(count_format)
+        if string_count < 0 or string_count > len(data) - pos:
+            raise ValueError("bad string count")
+        strings = [read_string() for i in range(string_count)]
+
+    element_count = read_format('<i')
+    if element_count < 0 or element_count*17 > len(data) - pos:
+        raise ValueError("bad element count")
+    elements = []
+    for i in range(element_count):
+        type_name = read_string() if version < 2 else strings[read_format(index_format)]
+        name = strings[read_format(index_format)] if names_in_table else read_string()
+        pos += 16
+        if not type_name.startswith("Dm") or pos > len(data):
+            raise ValueError("bad element header")
+        elements.append((type_name, name))
+    return strings, elements
+
+# The model dictionary, leaf and prop counts of a static prop lump, and where the props start. None if the counts
+# don't fit in the lump.
+
+
+def staticprop_counts(lump):
+    counts = []
+    pos = 0
+    for entry_size in (128, 2, 0):
+        if pos + 4 > len(lump):
+            return None
+        count, = struct.unpack_from('<i', lump, pos)
+        pos += 4 + entry_size*count
+        if count < 0 or pos > len(lump):
+            return None
+        counts.append(count)
+    return counts + [pos]
+
+# Find the size of one static prop. Versions with more than one known layout are told apart by the size of the prop array.
+
+
+def staticprop_record_size(lumpversion, array_size, static_props):
+    sizes = staticprop_record_sizes.get(lumpversion, ())
+    for size in sizes:
+        if size*static_props == array_size:
+            return size
+    for size in sizes:
+        if size*static_props <= array_size:
+            return size
+    # unknown version, so trust the lump size
+    size = array_size // static_props
+    if size >= 36 and size % 4 == 0:
+        return size
+    return None
+
+# Yield each entity in the entity lump as a list of (key, value), lowercase. Keys can repeat (outputs).
+
+
+def read_entities(entitylump):
+    entity = None
+    for match in entity_keyvalue.finditer(entitylump):
+        if match.lastindex == 3:
+            if match.group(3) == b'{':
+                entity = []
+            elif entity is not None:
+                yield entity
+                entity = None
+        elif entity is not None:
+            entity.append((match.group(1).decode("utf-8", "replace").lower(),
+                           match.group(2).decode("utf-8", "replace").lower()))
+
+# Memory-mapped bsp file. The lump table is parsed once, and lumps are memoryview slices of the map.
+
+
+class BspFile:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError("not a valid bsp file: "+path)
+        self.view = memoryview(self.map)
+        if len(self.view) < 1036 or self.view[0:4] != b'VBSP':
+            self.close()
+            raise ValueError("not a valid bsp file: "+path)
+
+        self.version, = struct.unpack_from('<i', self.view, 4)
+        # (fileofs, filelen, version, fourCC) of all 64 lumps
+        self.lumps = list(struct.iter_unpack('<iii4s', self.view[8:1032]))
+        for i, (fileofs, filelen, version, fourcc) in enumerate(self.lumps):
+            if filelen != 0 and (fileofs < 0 or filelen < 0 or fileofs + filelen > len(self.view)):
+                self.close()
+                raise ValueError("not a valid bsp file (lump {} is outside the file): ".format(i)+path)
+
+        # game lump id->(flags, version, memoryview)
+        self.game_lumps = {}
+        gamelump = self.lump(35)
+        if len(gamelump) >= 4:
+            lumpcount, = struct.unpack_from('<i', gamelump, 0)
+            if lumpcount < 0 or 4 + lumpcount*16 > len(gamelump):
+                del gamelump
+                self.close()
+                raise ValueError("not a valid bsp file (bad game lump count): "+path)
+            for lumpid, flags, version, fileofs, filelen in struct.iter_unpack('<iHHii', gamelump[4:4+(lumpcount*16)]):
+                self.game_lumps[lumpid] = (
+                    flags, version, self.view[fileofs:fileofs+filelen])
+
+    def lump(self, id):
+        fileofs, filelen = self.lumps[id][0:2]
+        return self.view[fileofs:fileofs+filelen]
+
+    # Slices of the map can outlive it, like in the frames of an exception being handled. The map can't be
+    # closed while they exist, so it's left to be unmapped when they're freed, and the file is closed anyway.
+    def close(self):
+        self.game_lumps = {}
+        try:
+            self.view.release()
+            self.map.close()
+        except BufferError:
             pass
-        elif line == "}":
-            entity_list.append(this_entity)
-            this_entity = {}
-        else:
-            parts = shlex.split(line.lower())
-            this_entity[parts[0]] = parts[1]
-
-    for ent in entity_list:
-        for k, v in ent.items():
-            k = k.lower()
-            if k == 'model' and v[0] != '*':
-                skin = -1
-                # only pack this model's skin, UNLESS it has a targetname, in which case it might change
-                for k2, v2 in ent.items():
-                    if k2 == 'skin':
-                        skin = int(v2)
-                for k2, v2 in ent.items():
-                    if k2 == 'targetname':
-                        skin = -1
-                add_mdl_file(v, skin)
+        finally:
+            self.file.close()
+
+# read-only file wrapper over a lump, so zipfile can read it without copying
+
+
+class LumpReader:
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.view)
+        if size >= 0:
+            end = min(self.pos+size, end)
+        data = self.view[self.pos:end].tobytes()
+        self.pos = max(self.pos, end)
+        return data
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.view)
+        if offset < 0:
+            raise OSError("negative seek in lump")
+        self.pos = offset
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        pass
+
+# file wrapper so zipfile writes offsets relative to the start of the pakfile lump
+
+
+class LumpWriter:
+    def __init__(self, f):
+        self.f = f
+        self.base = f.tell()
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def tell(self):
+        return self.f.tell() - self.base
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            offset += self.base
+        return self.f.seek(offset, whence) - self.base
+
+    def flush(self):
+        self.f.flush()
+
+# Compare the files to pack with the pakfile already in the bsp, by size, CRC32 and compression method.
+# Returns the files that are new or changed, the files an earlier run packed that aren't needed any more, a list of
+# (change, filename) and the size of the current pakfile.
+
+
+def diff_pakfile(bsp_path, pack_files, compression=zipfile.ZIP_STORED):
+    packed = {}
+    bsp = BspFile(bsp_path)
+    try:
+        pakfile_len = len(bsp.lump(40))
+        if pakfile_len > 0:
+            old_zip = zipfile.ZipFile(LumpReader(bsp.lump(40)))
+            for info in old_zip.infolist():
+                packed[sanitize_filename(info.filename)] = info
+            old_zip.close()
+            del old_zip
+    finally:
+        bsp.close()
+
+    changed = []
+    changelog = []
+    for name, source in pack_files:
+        info = packed.pop(name, None)
+        if info is not None:
+            size = source_size(source)
+            if (info.file_size == size and info.compress_type == compress_type(name, size, compression)
+                    and info.CRC == source_crc(source)):
+                continue
+        changed.append((name, source))
+        changelog.append(("added" if info is None else "replaced", name))
+    removed = set(name for name, info in packed.items() if info.comment == pack_marker)
+    changelog.extend(("removed", name) for name in sorted(removed))
+    return changed, removed, changelog, pakfile_len
+
 
-            # env_sprite uses "model" as the key for its material
-            if k == 'texture' or k == 'material' or k == 'detailmaterial' or k == 'model' or k == 'ropematerial':
-                dependencies[vmt_filename(v)] = False
+def source_size(source):
+    if isinstance(source, bytes):
+        return len(source)
+    return os.path.getsize(source)
 
-            if k == 'skyname':
-                dependencies[vmt_filename("skybox/"+v+"bk")] = False
-                dependencies[vmt_filename("skybox/"+v+"dn")] = False
-                dependencies[vmt_filename("skybox/"+v+"ft")] = False
-                dependencies[vmt_filename("skybox/"+v+"lf")] = False
-                dependencies[vmt_filename("skybox/"+v+"rt")] = False
-                dependencies[vmt_filename("skybox/"+v+"up")] = False
 
-    # Find Sounds
-    # todo: implement into above part (there are numerous entity keys that can reference a sound)
-    mapsounds = regex_find("[a-z0-9_\\- /\\\\]+\\.wav", entitylump)
-    mapsounds = mapsounds.union(regex_find(
-        "[a-z0-9_\\- /\\\\]+\\.ogg", entitylump))
-    mapsounds = mapsounds.union(regex_find(
-        "[a-z0-9_\\- /\\\\]+\\.mp3", entitylump))
+def source_crc(source):
+    if isinstance(source, bytes):
+        return zlib.crc32(source)
+    crc = 0
+    with open(source, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
 
-    for i in mapsounds:
-        dependencies["sound/"+i] = False
 
-# read a whole lump into a bytestring
+def compress_type(filename, size, compression):
+    if size >= compress_min_size and filename.rsplit(".", 1)[-1] in compressible_extensions:
+        return compression
+    return zipfile.ZIP_STORED
 
+# Lay out the lumps other than the pakfile in their original order, 4 byte aligned, with the pakfile at the end.
+# lumps is the lump table of a BspFile. Returns lump id->new offset, and the offset of the pakfile.
 
-def read_lump(bsp_file, id):
-    bsp_file.seek(8 + (id*16))
-    fileofs, = struct.unpack('<i', bsp_file.read(4))
-    filelen, = struct.unpack('<i', bsp_file.read(4))
-    bsp_file.seek(fileofs)
-    return bsp_file.read(filelen)
 
-# add skin of prop (-1 for all skins)
+def lump_layout(lumps):
+    new_offsets = {}
+    pos = 1036
+    for i in sorted(range(64), key=lambda i: lumps[i][0]):
+        if i == 40 or lumps[i][1] <= 0:
+            continue
+        pos = (pos + 3) & ~3
+        new_offsets[i] = pos
+        pos += lumps[i][1]
+    return new_offsets, (pos + 3) & ~3
 
+# Bytes a zip entry takes besides its data: the local header and the central directory entry
 
-def add_mdl_file(prop, skin):
-    dependencies[sanitize_filename(prop)] = False
-    if skin == -1:
-        all_model_skins.add(prop)
-    else:
-        if prop in model_skins:
-            model_skins[prop].add(skin)
-        else:
-            model_skins[prop] = set([skin])
 
+def zip_entry_overhead(name, comment=b'', extra=b''):
+    return 30 + 46 + 2*len(name.encode("utf-8")) + len(comment) + 2*len(extra)
+
+# How big a file (path or bytes) will be in the pakfile with a compression method. Big files are only compressed
+# up to plan_sample_size, and the rest is projected from the ratio.
 
-main()
+
+def compressed_size(source, size, method):
+    if method == zipfile.ZIP_STORED or size == 0:
+        return size
+    if method == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        compressed = 0
+    else:
+        # zipfile writes a 9 byte header before the raw LZMA1 stream
+        compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[{"id": lzma.FILTER_LZMA1}])
+        compressed = 9
+
+    if isinstance(source, bytes):
+        sample = source[:plan_sample_size]
+    else:
+        with open(source, 'rb') as file:
+            sample = file.read(plan_sample_size)
+    compressed += len(compressor.compress(sample)) + len(compressor.flush())
+    if len(sample) < size:
+        compressed = compressed * size // len(sample)
+    return compressed
+
+# Read the size, image format and number of mipmaps from the header of a vtf file
+
+
+def read_vtf_header(path):
+    with open(path, 'rb') as file:
+        header = file.read(64)
+    if len(header) < 57 or header[0:4] != b'VTF\0':
+        raise ValueError("not a vtf file")
+    width, height = struct.unpack_from('<HH', header, 16)
+    image_format, mips = struct.unpack_from('<iB', header, 52)
+    if 0 <= image_format < len(vtf_formats):
+        image_format = vtf_formats[image_format]
+    else:
+        image_format = "format {}".format(image_format)
+    return width, height, image_format, mips
+
+# Copy a member of an old pakfile (a lump) into a zip being written, as it is: the local header, the compressed
+# data and the data descriptor if it has one. It isn't decompressed and compressed again, or read into memory.
+# zipfile can't do this itself, so the member is added to its list for the central directory here.
+
+
+def copy_zip_member(new_zip, old_pakfile, info):
+    start = info.header_offset
+    if old_pakfile[start:start+4] != b'PK\x03\x04':
+        raise zipfile.BadZipFile("bad local header for "+info.filename)
+    name_length, extra_length = struct.unpack_from('<HH', old_pakfile, start + 26)
+    end = start + 30 + name_length + extra_length + info.compress_size
+    if info.flag_bits & 0x08:
+        end += 16 if old_pakfile[end:end+4] == b'PK\x07\x08' else 12
+    if end > len(old_pakfile):
+        raise zipfile.BadZipFile("truncated member "+info.filename)
+
+    new_zip.fp.seek(new_zip.start_dir)
+    info.header_offset = new_zip.start_dir
+    new_zip.fp.write(old_pakfile[start:end])
+    new_zip.start_dir = new_zip.fp.tell()
+    new_zip.filelist.append(info)
+    new_zip.NameToInfo[info.filename] = info
+
+# Rebuild the pakfile lump (40) with files added from disk, and rewrite the bsp in one pass.
+# pack_files yields (name in pakfile, path on disk or content as bytes). Existing pakfile entries are kept
+# unless replaced or in removed. Added entries are marked with pack_marker, and text files are compressed
+# with compression. Returns the size of the new pakfile and the bytes compression saved.
+
+
+def write_pakfile(bsp_path, pack_files, removed=(), compression=zipfile.ZIP_STORED):
+    bsp = BspFile(bsp_path)
+    lumps = [list(lump[0:3]) for lump in bsp.lumps]
+    new_offsets, pakfile_offset = lump_layout(lumps)
+
+    new_header = bytearray(bsp.view[0:1036])
+    for i in range(64):
+        fileofs = new_offsets.get(i, 0)
+        if i == 40:
+            fileofs = pakfile_offset
+            lumps[i][1] = 0
+            lumps[i][2] = 0
+        struct.pack_into('<ii', new_header, 8 + (i*16), fileofs, lumps[i][1])
+        struct.pack_into('<i', new_header, 8 + (i*16) + 8, lumps[i][2])
+
+    tmp_path = bsp_path + ".quickpack"
+    outfile = None
+    old_zip = None
+    old_pakfile = None
+    new_zip = None
+    try:
+        outfile = open(tmp_path, 'wb')
+        outfile.write(new_header)
+        for i, fileofs in sorted(new_offsets.items(), key=lambda x: x[1]):
+            outfile.write(b'\0' * (fileofs - outfile.tell()))
+            if i == 35:
+                # game lump entries use absolute file offsets, so they move with the lump
+                gamelump = bytearray(bsp.lump(i))
+                delta = fileofs - lumps[i][0]
+                # (BspFile checked that the count fits in the lump)
+                lumpcount = 0
+                if len(gamelump) >= 4:
+                    lumpcount, = struct.unpack_from('<i', gamelump, 0)
+                for j in range(lumpcount):
+                    spot = 4 + (j*16) + 8
+                    ofs, = struct.unpack_from('<i', gamelump, spot)
+                    if ofs != 0:
+                        struct.pack_into('<i', gamelump, spot, ofs + delta)
+                outfile.write(gamelump)
+            else:
+                outfile.write(bsp.lump(i))
+        outfile.write(b'\0' * (pakfile_offset - outfile.tell()))
+
+        replaced = set()
+        saved = 0
+        new_zip = zipfile.ZipFile(LumpWriter(outfile), 'w',
+                                  zipfile.ZIP_STORED, strict_timestamps=False)
+        for name, source in pack_files:
+            if isinstance(source, bytes):
+                info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+                info.file_size = len(source)
+                src = io.BytesIO(source)
+            else:
+                info = zipfile.ZipInfo.from_file(source, name, strict_timestamps=False)
+                src = open(source, 'rb')
+            info.comment = pack_marker
+            info.compress_type = compress_type(name, info.file_size, compression)
+            with src, new_zip.open(info, 'w') as dst:
+                shutil.copyfileobj(src, dst)
+            saved += info.file_size - info.compress_size
+            replaced.add(name)
+        if len(bsp.lump(40)) > 0:
+            old_pakfile = bsp.lump(40)
+            old_zip = zipfile.ZipFile(LumpReader(old_pakfile))
+            for info in old_zip.infolist():
+                filename = sanitize_filename(info.filename)
+                if filename not in replaced and filename not in removed:
+                    copy_zip_member(new_zip, old_pakfile, info)
+            old_zip.close()
+            del old_zip, old_pakfile
+        new_zip.close()
+
+        pakfile_len = outfile.tell() - pakfile_offset
+        outfile.seek(8 + (40*16) + 4)
+        outfile.write(struct.pack('<i', pakfile_len))
+        outfile.close()
+        bsp.close()
+        os.replace(tmp_path, bsp_path)
+    except BaseException:
+        if new_zip is not None:
+            # drop the half written pakfile without writing its directory to the closed file
+            new_zip.fp = None
+        if outfile is not None:
+            outfile.close()
+            delete_file(tmp_path)
+        # the old pakfile reads from the mapped bsp, which can't be closed while it's open
+        old_zip = None
+        old_pakfile = None
+        bsp.close()
+        raise
+    return pakfile_len, saved
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import argparse
+import io
+import os
+import random
+import shutil
+import struct
+import zipfile
+
+# Generates a synthetic game folder for the benchmarks: a map with entities, static props and brush
+# materials, models with many skin families, and brush materials that include each other in long chains.
+# Half of the models are in a folder mounted through cfg/mount.cfg. Nothing needs Steam or the game.
+
+# static prop record sizes by lump version (same as staticprop_record_sizes in QuickPack.py)
+prop_record_sizes = {4: 56, 5: 60, 6: 64, 7: 68, 8: 68, 9: 72, 10: 76, 11: 80}
+
+# settings generate() uses unless told otherwise
+defaults = {
+    "entities": 2000,
+    "props": 4000,
+    "prop_version": 10,
+    "models": 100,
+    "skin_families": 16,
+    "skin_refs": 4,
+    "materials": 300,
+    "include_depth": 8,
+    "texture_size": 16384,
+    "seed": 1,
+}
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(data.encode("utf-8") if isinstance(data, str) else data)
+
+# A model with just what QuickPack reads: the header fields at offset 204, texture entries and their
+# names, texture dirs and the skin table. skins is a list of families, each a list of texture indexes.
+
+
+def write_mdl(path, textures, texturedirs, skins):
+    header = bytearray(408)
+    header[0:4] = b'IDST'
+    texture_offset = len(header)
+    entries = bytearray(64*len(textures))
+    strings = bytearray()
+    strings_offset = texture_offset + len(entries)
+    for tex_id, texture in enumerate(textures):
+        struct.pack_into('<i', entries, 64*tex_id, strings_offset + len(strings) - (texture_offset + 64*tex_id))
+        strings += texture.encode("utf-8") + b'\0'
+    dir_offsets = []
+    for texturedir in texturedirs:
+        dir_offsets.append(strings_offset + len(strings))
+        strings += texturedir.encode("utf-8") + b'\0'
+    texturedir_offset = strings_offset + len(strings)
+    dirs = struct.pack('<{}i'.format(len(dir_offsets)), *dir_offsets)
+    skin_offset = texturedir_offset + len(dirs)
+    skin_table = b''.join(struct.pack('<{}H'.format(len(family)), *family) for family in skins)
+    struct.pack_into('<7i', header, 204, len(textures), texture_offset, len(texturedirs), texturedir_offset,
+                     len(skins[0]), len(skins), skin_offset)
+    write_file(path, bytes(header) + bytes(entries) + bytes(strings) + dirs + skin_table)
+
+# A version 20 bsp with an entity lump, texdata strings, a static prop game lump and a pakfile.
+# props is a list of (model name, skin).
+
+
+def write_bsp(path, entities, texture_names, props, prop_version, pakfile_files):
+    lumps = {}
+    lumps[0] = "".join("{\n" + "".join('"{}" "{}"\n'.format(k, v) for k, v in entity) + "}\n"
+                       for entity in entities).encode("utf-8") + b'\0'
+    lumps[43] = b''.join(name.encode("utf-8") + b'\0' for name in texture_names)
+
+    names = sorted(set(name for name, skin in props))
+    name_ids = dict((name, i) for i, name in enumerate(names))
+    record_size = prop_record_sizes[prop_version]
+    sprp = struct.pack('<i', len(names)) + b''.join(name.encode("utf-8").ljust(128, b'\0') for name in names)
+    sprp += struct.pack('<ii', 0, len(props))
+    records = bytearray(record_size*len(props))
+    for i, (name, skin) in enumerate(props):
+        struct.pack_into('<H', records, i*record_size + 24, name_ids[name])
+        struct.pack_into('<i', records, i*record_size + 32, skin)
+    sprp += bytes(records)
+
+    pakfile = io.BytesIO()
+    with zipfile.ZipFile(pakfile, 'w') as zip_file:
+        for name, data in pakfile_files.items():
+            zip_file.writestr(name, data)
+    lumps[40] = pakfile.getvalue()
+    lumps[1] = b'\x11' * 4096
+
+    out = bytearray(1036)
+    out[0:8] = b'VBSP' + struct.pack('<i', 20)
+    for lump_id in [1, 0, 43, 35, 40]:
+        out += b'\0' * (-len(out) % 4)
+        offset = len(out)
+        if lump_id == 35:
+            # one game lump, right after the game lump header
+            data = struct.pack('<iiHHii', 1, 1936749168, 0, prop_version, offset + 20, len(sprp)) + sprp
+        else:
+            data = lumps[lump_id]
+        struct.pack_into('<ii', out, 8 + lump_id*16, offset, len(data))
+        out += data
+    write_file(path, bytes(out))
+
+
+def vmt(shader, params):
+    return '"{}"\n{{\n{}}}\n'.format(shader, "".join('\t"{}" "{}" // generated\n'.format(k, v)
+                                                    for k, v in params))
+
+
+def vtf(size, seed):
+    return b'VTF\0' + bytes([seed % 256]) * max(size - 4, 0)
+
+# Write the corpus to root (which is emptied first) and return the path of the map
+
+
+def generate(root, entities=defaults["entities"], props=defaults["props"], prop_version=defaults["prop_version"],
+             models=defaults["models"], skin_families=defaults["skin_families"], skin_refs=defaults["skin_refs"],
+             materials=defaults["materials"], include_depth=defaults["include_depth"],
+             texture_size=defaults["texture_size"], seed=defaults["seed"]):
+    rng = random.Random(seed)
+    shutil.rmtree(root, ignore_errors=True)
+    game = root + "/game"
+    mount = root + "/mount"
+    write_file(game + "/cfg/mount.cfg", '"mountcfg"\n{{\n\t"bench"\t"{}"\n}}\n'.format(mount))
+
+    # models, each with skin_refs materials per skin
+    model_names = []
+    for i in range(models):
+        folder = game if i % 2 == 0 else mount
+        name = "models/bench/model{}.mdl".format(i)
+        textures = ["model{}_{}".format(i, j) for j in range(skin_families*skin_refs)]
+        skins = [[family*skin_refs + ref for ref in range(skin_refs)] for family in range(skin_families)]
+        write_mdl(folder + "/" + name, textures, ["models\\bench\\"], skins)
+        for ext in ["dx90.vtx", "vvd", "phy"]:
+            write_file(folder + "/" + name[:-4] + "." + ext, b'x' * 1024)
+        for texture in textures:
+            write_file(folder + "/materials/models/bench/" + texture + ".vmt",
+                       vmt("VertexLitGeneric", [("$basetexture", "models/bench/" + texture),
+                                                ("$bumpmap", "models/bench/" + texture + "_normal"),
+                                                ("%keywords", "bench")]))
+            write_file(folder + "/materials/models/bench/" + texture + ".vtf", vtf(texture_size, i))
+            write_file(folder + "/materials/models/bench/" + texture + "_normal.vtf", vtf(texture_size, i + 1))
+        model_names.append(name)
+
+    # brush materials, each the top of a chain of include_depth patch materials
+    texture_names = []
+    for i in range(materials):
+        for depth in range(include_depth):
+            name = "bench/brush{}_{}".format(i, depth)
+            if depth < include_depth - 1:
+                content = '"patch"\n{{\n\t"include" "materials/bench/brush{}_{}.vmt"\n\t"insert"\n\t{{\n' \
+                          '\t\t"$detail" "bench/detail{}"\n\t}}\n}}\n'.format(i, depth + 1, depth)
+            else:
+                content = vmt("LightmappedGeneric", [("$basetexture", name), ("$bumpmap", name + "_normal")])
+                write_file(game + "/materials/" + name + ".vtf", vtf(texture_size, i))
+                write_file(game + "/materials/" + name + "_normal.vtf", vtf(texture_size, i + 1))
+            write_file(game + "/materials/" + name + ".vmt", content)
+        texture_names.append("BENCH/BRUSH{}_0".format(i))
+    for depth in range(include_depth):
+        write_file(game + "/materials/bench/detail{}.vtf".format(depth), vtf(texture_size, depth))
+
+    for i in range(64):
+        write_file(game + "/sound/bench/sound{}.wav".format(i), b'RIFF' + b'\0' * 4096)
+
+    entity_list = [[("classname", "worldspawn"), ("skyname", "sky_bench")]]
+    write_file(game + "/materials/skybox/sky_benchrt.vmt", vmt("UnlitGeneric", [("$basetexture", "skybox/sky_benchrt")]))
+    write_file(game + "/materials/skybox/sky_benchrt.vtf", vtf(texture_size, 0))
+    for i in range(entities - 1):
+        kind = i % 4
+        if kind == 0:
+            entity_list.append([("classname", "prop_dynamic"), ("targetname", "prop{}".format(i)),
+                                ("model", rng.choice(model_names)), ("skin", str(rng.randrange(skin_families)))])
+        elif kind == 1:
+            entity_list.append([("classname", "ambient_generic"), ("targetname", "sound{}".format(i)),
+                                ("message", "bench/sound{}.wav".format(rng.randrange(64))), ("health", "10")])
+        elif kind == 2:
+            entity_list.append([("classname", "info_overlay"), ("material", "bench/brush{}_0".format(rng.randrange(materials))),
+                                ("sides", "1 2 3 4"), ("origin", "0 0 0")])
+        else:
+            entity_list.append([("classname", "light"), ("targetname", "light{}".format(i)), ("_light", "255 255 255 200"),
+                                ("origin", "{} {} {}".format(i, -i, i*2)), ("style", "0")])
+
+    prop_list = [(rng.choice(model_names), rng.randrange(skin_families)) for i in range(props)]
+    pakfile_files = {"materials/maps/bench/cubemap{}.vtf".format(i): vtf(1024, i) for i in range(8)}
+    map_path = game + "/maps/bench.bsp"
+    write_bsp(map_path, entity_list, texture_names, prop_list, prop_version, pakfile_files)
+    return map_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic game folder for benchmarking QuickPack')
+    parser.add_argument('root', help='Folder to generate into (emptied first)')
+    for key, value in defaults.items():
+        parser.add_argument('--' + key.replace("_", "-"), type=int, default=value)
+    args = parser.parse_args()
+    print(generate(**vars(args)))
+
+
+if __name__ == "__main__":
+    main()
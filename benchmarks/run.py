@@ -0,0 +1,100 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import corpus
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import QuickPack  # noqa: E402
+
+# Times each phase of packing a synthetic map (see corpus.py) and writes the results as JSON, so runs
+# can be compared between versions. The map is packed with Packer.pack, like QuickPack.py does, and the
+# phases are the ones --profile reports. Phases can nest: minify is also counted in write. Every run
+# starts cold: indexes and parsed files aren't reused unless --cache is passed.
+
+# the phases printed after each run (all of them are in the results)
+shown_phases = ["index", "pakfile lump", "texture lump", "static prop lump", "entity lump", "resolve", "minify", "write"]
+
+# Pack a copy of the map once. Returns (phase times from the Profiler, files packed, pakfile size).
+
+
+def run_once(map_path, work_path, args):
+    shutil.copyfile(map_path, work_path)
+    gameroot = os.path.dirname(os.path.dirname(work_path))
+    profiler = QuickPack.Profiler()
+
+    with profiler.phase("index"):
+        packer = QuickPack.Packer(gameroot, use_cache=args.cache)
+    options = QuickPack.pack_options(minify_vmt=True, jobs=args.jobs, compress=args.compress, plan=args.plan)
+    summary = packer.pack(work_path, options, profiler)
+    packer.save_cache()
+    return profiler.report()["phases"], summary["files"], summary["pakfile_bytes"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the phases of packing a synthetic map')
+    parser.add_argument('--out', metavar='FILE', help='Write the results to a JSON file (default: print them)')
+    parser.add_argument('--repeat', type=int, default=3, help='Pack this many times and keep the fastest of each phase')
+    parser.add_argument('--jobs', type=int, default=1, help='Passed on as QuickPack --jobs')
+    parser.add_argument('--cache', action="store_true", help='Use the QuickPack cache (warm after the first run)')
+    parser.add_argument('--compress', choices=sorted(QuickPack.compression_methods), default="none",
+                        help='Passed on as QuickPack --compress')
+    parser.add_argument('--plan', action="store_true", help='Passed on as QuickPack --plan (nothing is written)')
+    parser.add_argument('--root', metavar='DIR', help='Generate the corpus here instead of a temp folder')
+    for key, value in corpus.defaults.items():
+        parser.add_argument('--' + key.replace("_", "-"), type=int, default=value)
+    args = parser.parse_args()
+
+    settings = dict((key, getattr(args, key)) for key in corpus.defaults)
+    root = args.root or tempfile.mkdtemp(prefix="quickpack_bench_")
+    try:
+        start = time.perf_counter()
+        map_path = corpus.generate(root, **settings)
+        print("Generated corpus in {:.2f} s".format(time.perf_counter() - start))
+
+        runs = []
+        for i in range(args.repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                times, files, pakfile_size = run_once(map_path, map_path[:-4] + "_work.bsp", args)
+            runs.append(times)
+            print("Run {}: {}".format(i + 1, ", ".join("{} {:.3f} s".format(phase, times[phase]["wall"])
+                                                    for phase in shown_phases if phase in times)))
+    finally:
+        if args.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    # a phase that didn't happen in a run (like parsing, with a warm cache) took no time
+    phases = list(dict.fromkeys(phase for run in runs for phase in run))
+    runs = [dict((phase, run.get(phase, {"wall": 0.0, "cpu": 0.0})) for phase in phases) for run in runs]
+    results = {
+        "corpus": settings,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "jobs": args.jobs,
+        "cache": args.cache,
+        "compress": args.compress,
+        "plan": args.plan,
+        "files": files,
+        "pakfile_bytes": pakfile_size,
+        "phases": dict((phase, {"wall": round(min(run[phase]["wall"] for run in runs), 6),
+                                "cpu": round(min(run[phase]["cpu"] for run in runs), 6),
+                                "runs": [round(run[phase]["wall"], 6) for run in runs]})
+                       for phase in phases),
+    }
+    if args.out:
+        with open(args.out, 'w') as outfile:
+            json.dump(results, outfile, indent=1)
+        print("Wrote "+args.out)
+    else:
+        print(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import contextlib
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "benchmarks"))
+import QuickPack  # noqa: E402
+import corpus  # noqa: E402
+
+# Maps that are broken in different ways must fail with their own error, and leave the map closed so it
+# isn't locked (on Windows) while --watch or --batch goes on.
+
+
+class CorruptMapTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="quickpack_test_")
+        self.map_path = corpus.generate(self.root, entities=20, props=10, models=2, skin_families=2, skin_refs=1,
+                                        materials=2, include_depth=2, texture_size=64)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def lump(self, lump_id):
+        with open(self.map_path, 'rb') as file:
+            file.seek(8 + lump_id*16)
+            return struct.unpack('<ii', file.read(8))
+
+    def patch(self, offset, data):
+        with open(self.map_path, 'r+b') as file:
+            file.seek(offset)
+            file.write(data)
+
+    # pack the map, and return what was printed
+    def pack(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            packer = QuickPack.Packer(os.path.dirname(os.path.dirname(self.map_path)), use_cache=False)
+            packer.pack(self.map_path, QuickPack.pack_options())
+        return output.getvalue()
+
+    def assert_closed(self):
+        path = os.path.realpath(self.map_path)
+        if os.path.isdir("/proc/self/fd"):
+            fds = [fd for fd in os.listdir("/proc/self/fd") if os.path.realpath("/proc/self/fd/"+fd) == path]
+            self.assertEqual(fds, [])
+        if os.path.isfile("/proc/self/maps"):
+            with open("/proc/self/maps") as maps:
+                self.assertNotIn(path, maps.read())
+
+    def test_pakfile_not_a_zip(self):
+        fileofs, filelen = self.lump(40)
+        self.patch(fileofs + filelen - 22, b'XXXX')  # end of central directory record
+        with self.assertRaises(QuickPack.PackError) as context:
+            self.pack()
+        self.assertIn("ERROR in pakfile", str(context.exception))
+        del context
+        self.assert_closed()
+
+    def test_bad_static_prop_dictionary(self):
+        fileofs, filelen = self.lump(35)
+        self.patch(fileofs + 20, struct.pack('<i', 1000000))  # model name count
+        self.assertIn("static prop lump version 10 is damaged", self.pack())
+        self.assert_closed()
+
+    def test_bad_static_prop_count(self):
+        fileofs, filelen = self.lump(35)
+        self.patch(fileofs + 20 + 4 + 2*128, struct.pack('<i', -5))  # leaf count
+        self.assertIn("static prop lump version 10 is damaged", self.pack())
+        self.assert_closed()
+
+    def test_unterminated_static_prop_name(self):
+        fileofs, filelen = self.lump(35)
+        self.patch(fileofs + 20 + 4, b'x'*128)  # first model name, without its terminator
+        self.assertIn("invalid static prop model name 0", self.pack())
+        self.assert_closed()
+
+    def test_bad_game_lump_count(self):
+        fileofs, filelen = self.lump(35)
+        self.patch(fileofs, struct.pack('<i', 1000000))
+        with self.assertRaises(QuickPack.PackError) as context:
+            self.pack()
+        self.assertIn("bad game lump count", str(context.exception))
+        del context
+        self.assert_closed()
+
+    def test_truncated_map(self):
+        with open(self.map_path, 'rb') as file:
+            data = file.read(2000)
+        with open(self.map_path, 'wb') as file:
+            file.write(data)
+        with self.assertRaises(QuickPack.PackError) as context:
+            self.pack()
+        self.assertIn("is outside the file", str(context.exception))
+        del context
+        self.assert_closed()
+
+    def test_bad_local_header(self):
+        fileofs, filelen = self.lump(40)
+        self.patch(fileofs, b'XXXX')  # first member's local header
+        with open(self.map_path, 'rb') as file:
+            before = file.read()
+        with self.assertRaises(QuickPack.PackError) as context:
+            self.pack()
+        self.assertIn("bad local header", str(context.exception))
+        del context
+        self.assert_closed()
+        with open(self.map_path, 'rb') as file:
+            self.assertEqual(file.read(), before)
+        self.assertFalse(os.path.exists(self.map_path + ".quickpack"))
+
+
+if __name__ == "__main__":
+    unittest.main()